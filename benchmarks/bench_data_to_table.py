@@ -0,0 +1,64 @@
+""" microbenchmark of the table formatting in Hafas.data_to_records
+
+run from the project directory: python -m benchmarks.bench_data_to_table
+"""
+import timeit
+
+import pandas as pd
+
+from benchmarks.bench_get_data import vectorised
+from benchmarks.replay import synthetic_departures
+from src.transport.Hafas import Hafas
+
+SIZES = [15, 30, 60, 120, 250, 500]
+
+
+def legacy(df: pd.DataFrame) -> list:
+    # the former implementation: apply() per row, O(n^2) stripes
+    # and it worked on the frame of the caller
+    df = df.copy()
+    df['delay'] = round(df['delay'].dt.total_seconds() / 60).astype(int)
+    time_string = df['dateTime'].dt.strftime('%H:%M')
+    delay_string = df['delay'].apply(lambda u: '({:+d})'.format(u))
+    delay_string[df['delay'] == 0] = ''
+    df['Abfahrt'] = time_string + ' ' + delay_string
+    df['Bahnsteig'] = df['platform'].str.strip().values
+    df['Linie'] = df['name'].str.strip().values
+    df['Richtung'] = df['direction'].str.strip().values
+
+    stripes = 'platform_direction'
+    if stripes is not None and df[stripes].nunique() > 1:
+        stripes_rows = [i for i in list(df.index) if
+                        df.loc[i, stripes] in df[stripes].unique()[::2]]
+    else:
+        stripes_rows = []
+    df['stripe'] = 0
+    df.loc[stripes_rows, 'stripe'] = 1
+
+    df = df.reset_index(drop=True)
+    return df[Hafas.table_columns + ['stripe']].to_dict('records')
+
+
+def board(n_rows: int) -> pd.DataFrame:
+    # a board with n_rows departures as returned by Hafas.get_data
+    return vectorised(synthetic_departures(4 * n_rows), n_rows)
+
+
+def main():
+    print(f'{"rows":>6} {"legacy [ms]":>12} {"new [ms]":>10} {"speed-up":>9}')
+    for n in SIZES:
+        df = board(n)
+        before = df.copy()
+        assert legacy(df) == Hafas.data_to_records(df)
+        assert df.equals(before)
+        number = max(1, 1000 // n)
+        t_legacy = min(timeit.repeat(lambda: legacy(df),
+                                     number=number, repeat=5)) / number
+        t_new = min(timeit.repeat(lambda: Hafas.data_to_records(df),
+                                  number=number, repeat=5)) / number
+        print(f'{len(df):>6} {t_legacy * 1e3:>12.2f} {t_new * 1e3:>10.2f} '
+              f'{t_legacy / t_new:>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
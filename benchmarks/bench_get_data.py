@@ -0,0 +1,86 @@
+""" microbenchmark of the departure post-processing in Hafas.get_data
+
+run from the project directory: python -m benchmarks.bench_get_data
+"""
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.replay import synthetic_departures
+from src.transport.DepartureBoard import DepartureBoard
+from src.transport.Hafas import Hafas
+from src.utils import convert_tz
+
+SIZES = [50, 100, 250, 500, 1000, 2000]
+N_ROWS = 15
+
+
+def legacy(departures: list, n_rows: int) -> pd.DataFrame:
+    # the former implementation: list of lists and groupby().apply()
+    df = []
+    for dep in departures:
+        df.append([dep.station.id, dep.id, dep.cancelled, dep.dateTime,
+                   dep.delay, dep.direction, dep.name, dep.platform])
+    df = pd.DataFrame(
+        data=df,
+        columns=['station_id', 'trip_id', 'cancelled', 'dateTime', 'delay',
+                 'direction', 'name', 'platform']
+    )
+    df = df[~(df['cancelled'])].copy()
+    df['platform_direction'] = df['platform']
+    df = convert_tz(df)
+    df['dateTime'] = pd.to_datetime(df['dateTime'])
+    df['delay'] = pd.to_timedelta(df['delay'])
+    df['delay'] = df['delay'].fillna(pd.Timedelta(0))
+    df['actualDepartTime'] = df['dateTime'] + df['delay']
+
+    def foo(g, n_trips):
+        f = g.sort_values(by='actualDepartTime', ascending=True)
+        f = f if len(f) <= n_trips else f.iloc[:n_trips, :]
+        return f
+
+    n_trips = int(np.ceil(n_rows / df['platform_direction'].nunique()))
+    df = df.groupby('platform_direction').apply(foo, n_trips)
+    return df.reset_index(drop=True)
+
+
+def vectorised(departures: list, n_rows: int) -> pd.DataFrame:
+    df = Hafas.departures_to_frame(departures)
+    df = df[~df['cancelled']].copy()
+    df['platform_direction'] = df['platform'].astype(str)
+    df = convert_tz(df)
+    return Hafas.trim_departures(df, n_rows)
+
+
+def check_empty():
+    # a station without departures gives an empty board of the same
+    # column types, the merge builds its trip keys from them
+    empty = Hafas.departures_to_frame([])
+    full = Hafas.departures_to_frame(synthetic_departures(10))
+    assert empty.empty and \
+        empty.dtypes.astype(str).equals(full.dtypes.astype(str))
+    assert DepartureBoard().merge(empty).empty
+    assert vectorised([], N_ROWS).empty
+
+
+def main():
+    check_empty()
+    print(f'{"rows":>6} {"legacy [ms]":>12} {"new [ms]":>10} {"speed-up":>9}')
+    for n in SIZES:
+        departures = synthetic_departures(n)
+        # both variants have to pick the same departures (ties may differ)
+        cols = ['platform_direction', 'actualDepartTime']
+        assert (legacy(departures, N_ROWS)[cols].equals(
+            vectorised(departures, N_ROWS)[cols]))
+        number = max(1, 2000 // n)
+        t_legacy = min(timeit.repeat(lambda: legacy(departures, N_ROWS),
+                                     number=number, repeat=5)) / number
+        t_new = min(timeit.repeat(lambda: vectorised(departures, N_ROWS),
+                                  number=number, repeat=5)) / number
+        print(f'{n:>6} {t_legacy * 1e3:>12.2f} {t_new * 1e3:>10.2f} '
+              f'{t_legacy / t_new:>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
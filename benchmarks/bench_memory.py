@@ -0,0 +1,112 @@
+""" resident memory per monitored station of the departures and the
+station metadata Hafas keeps between refreshes
+
+before: the pyhafas legs in the departure cache, a board frame with
+object columns and the pyhafas Station, as kept before the typed store
+after: the categorical frame in the departure cache, the DepartureBoard
+built from it and the slotted Stop
+
+every variant runs in a fresh interpreter, the memory is the resident
+set size after building the boards minus the one before
+
+run from the project directory: python -m benchmarks.bench_memory
+"""
+import gc
+import random
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+from pyhafas.types.fptf import Station
+
+from benchmarks.replay import synthetic_departures
+
+SIZES = [50, 200, 500]
+DEPARTURES = 250  # per station, a large station in the 180 min window
+PLATFORMS = 0.7  # share of the departures with a platform
+
+
+def rss() -> float:
+    # resident set size in MB
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    raise OSError('VmRSS not available')
+
+
+def legacy_frame(departures: list) -> pd.DataFrame:
+    # the former frame: python strings in object columns
+    date_time = pd.to_datetime(
+        np.array([dep.dateTime.timestamp() for dep in departures],
+                 dtype=float), unit='s', utc=True)
+    delay = pd.to_timedelta(
+        np.array([dep.delay.total_seconds() if dep.delay else 0.0
+                  for dep in departures], dtype=float), unit='s')
+    return pd.DataFrame({
+        'station_id': [dep.station.id for dep in departures],
+        'trip_id': [dep.id for dep in departures],
+        'cancelled': np.array([bool(dep.cancelled) for dep in departures],
+                              dtype=bool),
+        'dateTime': date_time,
+        'delay': delay,
+        'actualDepartTime': date_time + delay,
+        'direction': [dep.direction for dep in departures],
+        'name': [dep.name for dep in departures],
+        'platform': [dep.platform for dep in departures],
+        'product': [dep.product for dep in departures],
+    })
+
+
+def build(variant: str, n: int) -> list:
+    from src.transport.DepartureBoard import DepartureBoard
+    from src.transport.Hafas import Hafas
+    from src.transport.StationIndex import Stop
+
+    rng = random.Random(0)
+    kept = []
+    for i in range(n):
+        station = Station(id=str(8000000 + i), name=f'Station {i} (Berlin)',
+                          latitude=52.5, longitude=13.4)
+        departures = synthetic_departures(DEPARTURES, station, rng,
+                                          platforms=PLATFORMS)
+        if variant == 'before':
+            kept.append((station, departures, legacy_frame(departures)))
+        else:
+            frame = Hafas.departures_to_frame(departures)
+            board = DepartureBoard()
+            board.merge(frame)
+            kept.append((Stop.from_station(station), frame, board))
+    return kept
+
+
+def measure(variant: str, n: int) -> float:
+    # RSS in MB of the boards of n stations, in a fresh interpreter
+    out = subprocess.run(
+        [sys.executable, '-W', 'ignore', '-m', 'benchmarks.bench_memory',
+         variant, str(n)], capture_output=True, text=True, check=True)
+    return float(out.stdout)
+
+
+def main():
+    print(f'{"stations":>8} {"before [kB]":>12} {"after [kB]":>11} '
+          f'{"saved":>6}  (RSS per station)')
+    for n in SIZES:
+        before = measure('before', n) * 1024 / n
+        after = measure('after', n) * 1024 / n
+        print(f'{n:>8} {before:>12.1f} {after:>11.1f} '
+              f'{1 - after / before:>6.0%}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        # warm up pandas, then measure one variant
+        build(sys.argv[1], 1)
+        gc.collect()
+        start = rss()
+        boards = build(sys.argv[1], int(sys.argv[2]))
+        gc.collect()
+        print(rss() - start)
+    else:
+        main()
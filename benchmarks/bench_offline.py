@@ -0,0 +1,180 @@
+""" end-to-end latency and allocations of the transport and weather
+callbacks for 1-20 stations, HAFAS, the geocoder and MOSMIX are
+replayed from benchmarks/fixtures so it runs without network access
+
+cold: first selection with empty caches, every station is fetched
+warm: the same selection again from the scheduler snapshots, as pushed
+to the clients after a refresh
+refresh: the transport boards fetched again by the scheduler, merged
+into the boards of the previous refresh or rebuilt from scratch
+figure: the weather figure of the forecasts, every hourly value or
+downsampled to DWD.max_points points per chart
+
+run from the project directory: python -m benchmarks.bench_offline
+"""
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from plotly.io.json import to_json_plotly
+
+from benchmarks.replay import ReplayGeocoder, ReplayHafasClient, \
+    ReplayMosmix, load_fixture
+
+SIZES = [1, 2, 5, 10, 20]
+REPEAT = 5
+N_ROWS = 15
+TIMEDELTA = 5
+SESSION = 'benchmark'
+UPSTREAM_LATENCY = 0.0  # s per replayed call, 0 measures the local work
+
+# separate caches which are emptied before each cold run
+CACHE_DIR = tempfile.mkdtemp(prefix='dashboard-bench-')
+os.environ['CACHE_DIR'] = CACHE_DIR
+os.environ['CACHE_BACKEND'] = 'memory'
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+
+def reset(dashboard, hafas: dict, weather: dict) -> list:
+    # fresh instances with empty caches and replaying clients
+    from src.Cache import TTLCache
+    from src.Scheduler import Scheduler
+    from src.transport.Hafas import Hafas
+    from src.weather.DWD import DWD
+
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    os.makedirs(CACHE_DIR)
+    clients = [ReplayHafasClient(hafas, latency=UPSTREAM_LATENCY),
+               ReplayGeocoder(weather, latency=UPSTREAM_LATENCY),
+               ReplayMosmix(weather, latency=UPSTREAM_LATENCY)]
+    dashboard.transport = Hafas(
+        departure_ttl=dashboard.DEPARTURE_CACHE_TTL,
+        departure_cache_size=dashboard.DEPARTURE_CACHE_SIZE,
+        client=clients[0])
+    dashboard.weather = DWD(dashboard.api_keys, client=clients[2],
+                            geocoder=clients[1])
+    dashboard.scheduler = Scheduler(workers=dashboard.SCHEDULER_WORKERS)
+    dashboard.weather_figures = TTLCache(
+        ttl=dashboard.weather_figures.ttl,
+        maxsize=dashboard.weather_figures.maxsize)
+    return clients
+
+
+def get_transport_data(dashboard, names: list, cold: bool):
+    if cold:
+        dashboard.get_transport_tables(names, SESSION, N_ROWS, TIMEDELTA)
+    else:
+        dashboard.get_transport_boards(names, N_ROWS, TIMEDELTA)
+
+
+def get_weather_data(dashboard, names: list, cold: bool):
+    dashboard.get_weather_data(names, SESSION)
+
+
+def measure_refresh(dashboard, fixtures: tuple, names: list) -> dict:
+    result = {}
+    for merge in (True, False):
+        reset(dashboard, *fixtures)
+        dashboard.transport.merge_boards = merge
+        times = []
+        for i in range(REPEAT + 1):
+            # new departures, the same trips
+            dashboard.transport._departure_cache.clear()
+            start = time.perf_counter()
+            for name in names:
+                dashboard.fetch_transport_data(name, N_ROWS, TIMEDELTA)
+            if i > 0:
+                times.append(time.perf_counter() - start)
+        result[merge] = statistics.median(times)
+    return result
+
+
+def measure_figure(dashboard, fixtures: tuple, names: list) -> dict:
+    # render time [s] and JSON size [kB] with and without downsampling
+    reset(dashboard, *fixtures)
+    df = dashboard.weather.get_data(names)
+    result = {}
+    for max_points in (dashboard.weather.max_points, None):
+        dashboard.weather.max_points = max_points
+        times = []
+        for _ in range(REPEAT):
+            start = time.perf_counter()
+            figure = dashboard.weather.data_to_figure(df)
+            times.append(time.perf_counter() - start)
+        result[max_points is not None] = (statistics.median(times),
+                                          len(to_json_plotly(figure)) / 1024)
+    return result
+
+
+def measure(dashboard, fixtures: tuple, callback, names: list) -> dict:
+    cold, warm = [], []
+    for _ in range(REPEAT):
+        clients = reset(dashboard, *fixtures)
+        start = time.perf_counter()
+        callback(dashboard, names, cold=True)
+        cold.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        callback(dashboard, names, cold=False)
+        warm.append(time.perf_counter() - start)
+    calls = sum(sum(client.calls.values()) for client in clients)
+
+    # allocations of a separate cold run, tracing slows it down
+    reset(dashboard, *fixtures)
+    tracemalloc.start()
+    callback(dashboard, names, cold=True)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'cold': statistics.median(cold), 'warm': statistics.median(warm),
+            'peak': peak / 2 ** 20, 'calls': calls}
+
+
+def main():
+    import dashboard
+
+    hafas, weather = load_fixture('hafas'), load_fixture('weather')
+    stations = [name for name, found in hafas['locations'].items()
+                if found and found[0]['name'] == name]
+    places = [results[0][0] for name, results in weather['geocode'].items()
+              if results and results[0][0] != name]
+    # the lazily imported modules are loaded before measuring
+    reset(dashboard, hafas, weather)
+    get_weather_data(dashboard, places[:1], cold=True)
+
+    for title, callback, names in [
+            ('get_transport_data', get_transport_data, stations),
+            ('get_weather_data', get_weather_data, places)]:
+        print(f'{title} ({REPEAT} runs, median)')
+        print(f'{"stations":>8} {"cold [ms]":>10} {"warm [ms]":>10} '
+              f'{"peak [MB]":>10} {"upstream calls":>15}')
+        for n in SIZES:
+            result = measure(dashboard, (hafas, weather), callback, names[:n])
+            print(f'{n:>8} {result["cold"] * 1e3:>10.1f} '
+                  f'{result["warm"] * 1e3:>10.1f} {result["peak"]:>10.1f} '
+                  f'{result["calls"]:>15}')
+        print()
+
+    print(f'refresh of the transport boards ({REPEAT} runs, median)')
+    print(f'{"stations":>8} {"merged [ms]":>12} {"rebuilt [ms]":>13}')
+    for n in SIZES:
+        result = measure_refresh(dashboard, (hafas, weather), stations[:n])
+        print(f'{n:>8} {result[True] * 1e3:>12.1f} '
+              f'{result[False] * 1e3:>13.1f}')
+    print()
+
+    print(f'weather figure ({REPEAT} runs, median)')
+    print(f'{"stations":>8} {"downsampled [ms]":>17} {"[kB]":>6} '
+          f'{"all points [ms]":>16} {"[kB]":>6}')
+    for n in SIZES:
+        result = measure_figure(dashboard, (hafas, weather), places[:n])
+        print(f'{n:>8} {result[True][0] * 1e3:>17.1f} '
+              f'{result[True][1]:>6.0f} {result[False][0] * 1e3:>16.1f} '
+              f'{result[False][1]:>6.0f}')
+    print()
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+""" import time and resident memory of the dashboard and its dependencies
+
+every module is imported in a fresh interpreter, the memory is the
+resident set size after the import minus the one of a bare interpreter
+
+run from the project directory: python -m benchmarks.bench_startup
+"""
+import subprocess
+import sys
+
+MODULES = ['dash', 'dash_bootstrap_components', 'pandas', 'plotly.express',
+           'wetterdienst.provider.dwd.mosmix', 'geopy.geocoders',
+           'scipy.spatial', 'pyhafas.client', 'src.transport.Hafas',
+           'src.weather.DWD', 'dashboard']
+# cold start budget of the dashboard (small ARM kiosks)
+STARTUP_BUDGET = 2.5  # s
+MEMORY_BUDGET = 200  # MB
+# heavy modules that must not be loaded by importing the dashboard
+DEFERRED = ['wetterdienst', 'polars', 'plotly.express', 'geopy',
+            'scipy.spatial']
+
+PROBE = """
+import sys, time
+def rss():
+    # resident set size in MB, ru_maxrss is the fallback for non-linux
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+module = sys.argv[1]
+before = rss()
+start = time.perf_counter()
+if module:
+    __import__(module)
+print(time.perf_counter() - start, rss(), before,
+      ','.join(m for m in sys.argv[2].split(',') if m in sys.modules))
+"""
+
+
+def measure(module: str) -> tuple:
+    # (import time [s], resident memory [MB], loaded deferred modules)
+    out = subprocess.run(
+        [sys.executable, '-W', 'ignore', '-c', PROBE, module,
+         ','.join(DEFERRED)],
+        capture_output=True, text=True, check=True).stdout.split()
+    loaded = out[3].split(',') if len(out) > 3 else []
+    return float(out[0]), float(out[1]), loaded
+
+
+def main():
+    _, baseline, _ = measure('')
+    print(f'bare interpreter: {baseline:.1f} MB')
+    print(f'{"module":<34} {"import [s]":>10} {"RSS [MB]":>9}')
+    results = {}
+    for module in MODULES:
+        results[module] = measure(module)
+        seconds, rss, _ = results[module]
+        print(f'{module:<34} {seconds:>10.2f} {rss - baseline:>9.1f}')
+
+    seconds, rss, loaded = results['dashboard']
+    rss -= baseline
+    print(f'\ndashboard: {seconds:.2f} s (budget {STARTUP_BUDGET} s), '
+          f'{rss:.1f} MB (budget {MEMORY_BUDGET} MB)')
+    if loaded:
+        print(f'loaded at startup although deferred: {", ".join(loaded)}')
+    if seconds > STARTUP_BUDGET or rss > MEMORY_BUDGET or loaded:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+""" records the HAFAS, geocoder and MOSMIX responses replayed by the
+offline benchmarks into benchmarks/fixtures
+
+run from the project directory: python -m benchmarks.record_fixtures
+without network access, python -m benchmarks.record_fixtures synthetic
+writes deterministic made-up responses of the same shape instead
+"""
+import json
+import os
+import random
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from pyhafas.profile import DBProfile
+
+from benchmarks.replay import FIXTURES
+from src.ApiKeys import ApiKeys
+from src.weather.DWD import DWD, EARTH_RADIUS
+
+# 20 boards each, the benchmarks use the first n of them
+STATIONS = ['S+U Alexanderplatz (Berlin)', 'S+U Friedrichstr. (Berlin)',
+            'S+U Berlin Hauptbahnhof', 'S+U Zoologischer Garten (Berlin)',
+            'S+U Potsdamer Platz (Berlin)', 'S Hackescher Markt (Berlin)',
+            'S+U Warschauer Str. (Berlin)', 'S Ostkreuz (Berlin)',
+            'S+U Gesundbrunnen (Berlin)', 'S Südkreuz (Berlin)',
+            'S+U Schönhauser Allee (Berlin)', 'U Kottbusser Tor (Berlin)',
+            'U Hermannplatz (Berlin)', 'S+U Wedding (Berlin)',
+            'S+U Frankfurter Allee (Berlin)',
+            'U Rosa-Luxemburg-Platz (Berlin)',
+            'S+U Rathaus Steglitz (Berlin)', 'S Savignyplatz (Berlin)',
+            'U Senefelderplatz (Berlin)', 'S+U Neukölln (Berlin)']
+PLACES = {'Berlin': (52.52, 13.405), 'Hamburg': (53.551, 9.994),
+          'München': (48.137, 11.575), 'Köln': (50.938, 6.96),
+          'Frankfurt am Main': (50.11, 8.682), 'Stuttgart': (48.776, 9.183),
+          'Düsseldorf': (51.228, 6.774), 'Leipzig': (51.34, 12.375),
+          'Dortmund': (51.514, 7.466), 'Essen': (51.456, 7.012),
+          'Bremen': (53.079, 8.802), 'Dresden': (51.05, 13.738),
+          'Hannover': (52.376, 9.732), 'Nürnberg': (49.452, 11.077),
+          'Rostock': (54.092, 12.099), 'Kiel': (54.323, 10.123),
+          'Freiburg im Breisgau': (47.999, 7.842), 'Erfurt': (50.985, 11.03),
+          'Potsdam': (52.391, 13.065), 'Görlitz': (51.152, 14.987)}
+DURATION = 180  # minutes of departures per board (Hafas.departure_window)
+HOURS = 240  # hours of forecast per station
+# departures are stored as rows, route indexes the list of routes
+HAFAS_COLUMNS = ['id', 'name', 'direction', 'minutes', 'delay',
+                 'cancelled', 'platform', 'route', 'product']
+# products of the synthetic lines by the start of their name
+LINE_PRODUCTS = {'S': 'suburban', 'U': 'subway', 'Bus': 'bus', 'M': 'tram'}
+
+
+def record_hafas(client) -> dict:
+    # departures of all products, one trip per line and direction
+    # without platform gives its route
+    now = datetime.now(DBProfile.timezone)
+    products = {p: True for p in DBProfile.availableProducts}
+    locations, departures, routes = {}, {}, []
+    for name in STATIONS:
+        found = client.locations(name) or []
+        found.sort(key=lambda s: s.name != name)
+        stations = [{'id': s.id, 'name': s.name} for s in found]
+        locations[name] = stations
+        if not found:
+            continue
+        locations[found[0].name] = stations
+        line_routes = {}
+        rows = []
+        for leg in client.departures(station=found[0], date=now,
+                                     duration=DURATION, max_trips=-1,
+                                     products=products):
+            route = None
+            if not leg.platform:
+                key = (leg.name, leg.direction)
+                if key not in line_routes:
+                    try:
+                        stops = [s.stop.id for s in
+                                 client.trip(leg.id).stopovers]
+                        routes.append(stops)
+                        line_routes[key] = len(routes) - 1
+                    except Exception as e:
+                        print(f'trip {leg.id} failed: {e!r}')
+                        line_routes[key] = None
+                route = line_routes[key]
+            rows.append([
+                leg.id, leg.name, leg.direction,
+                round((leg.dateTime - now).total_seconds() / 60),
+                leg.delay.total_seconds() if leg.delay is not None else None,
+                bool(leg.cancelled), leg.platform, route,
+                getattr(leg, 'product', None)])
+        departures[found[0].id] = {'columns': HAFAS_COLUMNS, 'rows': rows}
+    return {'locations': locations, 'departures': departures,
+            'routes': routes}
+
+
+def record_weather(geocoder, mosmix) -> dict:
+    geocode = {}
+    for place in PLACES:
+        results = geocoder.geocode(place, exactly_one=False, limit=5) or []
+        geocode[place] = [(r[0], list(r[1])) for r in results]
+        # the selected address is looked up again by itself
+        for address, latlon in geocode[place]:
+            geocode[address] = [(address, latlon)]
+    stations = mosmix.stations()
+    stations = stations[['station_id', 'name', 'latitude', 'longitude']]
+    stations = near_stations(stations, geocode)
+    forecast = mosmix.forecast(list(nearest_stations(stations, geocode)))
+    return {'geocode': geocode, 'issue': mosmix.issue_time(),
+            'stations': stations.to_dict('records'),
+            'forecast': forecast_values(forecast)}
+
+
+def distances(stations: pd.DataFrame, latlon) -> np.ndarray:
+    xyz = DWD._to_xyz(stations['latitude'].values,
+                      stations['longitude'].values)
+    chord = np.linalg.norm(xyz - DWD._to_xyz(*latlon), axis=-1)
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1.0))
+
+
+def near_stations(stations: pd.DataFrame, geocode: dict,
+                  radius: float = 100) -> pd.DataFrame:
+    # the catalogue has thousands of stations, keep the relevant ones
+    near = np.zeros(len(stations), dtype=bool)
+    for results in geocode.values():
+        for _, latlon in results:
+            near |= distances(stations, latlon) < radius
+    return stations[near].reset_index(drop=True)
+
+
+def nearest_stations(stations: pd.DataFrame, geocode: dict) -> set:
+    return {stations['station_id'].iloc[
+        int(np.argmin(distances(stations, latlon)))]
+        for results in geocode.values() for _, latlon in results}
+
+
+def forecast_values(forecast: pd.DataFrame) -> dict:
+    # station_id: parameter: hourly values
+    values = {}
+    forecast = forecast.sort_values('date')
+    for (station_id, parameter), df in forecast.groupby(
+            ['station_id', 'parameter'], observed=True):
+        values.setdefault(str(station_id), {})[str(parameter)] = [
+            None if np.isnan(v) else round(float(v), 1) for v in df['value']]
+    return values
+
+
+def synthetic_hafas(seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    locations, departures, routes = {}, {}, []
+    for i, name in enumerate(STATIONS):
+        station_id = str(8089000 + i)
+        locations[name] = [{'id': station_id, 'name': name}]
+        lines = [f'S {rng.randint(1, 9)}' if 'S' in name.split(' ')[0]
+                 else f'Bus {rng.randint(100, 300)}',
+                 f'U {rng.randint(1, 9)}' if 'U' in name.split(' ')[0]
+                 else f'M{rng.randint(1, 13)}',
+                 f'Bus {rng.randint(100, 300)}', f'M{rng.randint(1, 13)}']
+        rows = []
+        for line in lines:
+            for direction in ['Nord', 'Süd']:
+                platform = str(rng.randint(1, 4)) \
+                    if line.startswith('S') else None
+                route = None
+                if platform is None:
+                    routes.append([str(rng.randint(100000, 999999)),
+                                   station_id,
+                                   str(rng.randint(100000, 999999))])
+                    route = len(routes) - 1
+                headway = rng.choice([5, 10, 20])
+                for minutes in range(rng.randint(0, headway), DURATION,
+                                     headway):
+                    delay = rng.choice([None, 0, 0, 60, 120, 300, -60])
+                    rows.append([
+                        f'{station_id}|{line}|{direction}|{minutes}',
+                        line, f'{name.split(" (")[0]} {direction}',
+                        minutes, delay, rng.random() < 0.03, platform,
+                        route, LINE_PRODUCTS[line.split(' ')[0].rstrip(
+                            '0123456789')]])
+        rows.sort(key=lambda row: row[3])
+        departures[station_id] = {'columns': HAFAS_COLUMNS, 'rows': rows}
+    return {'locations': locations, 'departures': departures,
+            'routes': routes}
+
+
+def synthetic_weather(seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    geocode, stations = {}, []
+    for place, (lat, lon) in PLACES.items():
+        address = f'{place}, Deutschland'
+        geocode[place] = [(address, [lat, lon])]
+        geocode[address] = [(address, [lat, lon])]
+        for _ in range(3):
+            stations.append({
+                'station_id': str(10000 + len(stations)),
+                'name': f'{place.upper()} {len(stations) % 3 + 1}',
+                'latitude': round(lat + rng.uniform(-0.2, 0.2), 3),
+                'longitude': round(lon + rng.uniform(-0.3, 0.3), 3)})
+    stations = pd.DataFrame(stations)
+
+    hours = np.arange(HOURS)
+    daylight = np.clip(np.sin((hours % 24 - 6) / 12 * np.pi), 0, None)
+    forecast = {}
+    for station_id in sorted(nearest_stations(stations, geocode)):
+        np_rng = np.random.default_rng(int(station_id))
+        forecast[station_id] = {
+            'temperature_air_mean_200': 283 + 6 * daylight +
+            np_rng.normal(0, 1, HOURS).cumsum() / 4,
+            'wind_speed': np.abs(4 + np_rng.normal(0, 1, HOURS).cumsum() / 3),
+            'sunshine_duration': 3600 * daylight *
+            np_rng.uniform(0, 1, HOURS),
+            'precipitation_height_significant_weather_last_1h':
+                np.clip(np_rng.normal(-0.5, 0.6, HOURS), 0, None),
+            'humidity': np.clip(80 - 20 * daylight +
+                                np_rng.normal(0, 5, HOURS), 0, 100)}
+        forecast[station_id] = {k: [round(float(x), 1) for x in v]
+                                for k, v in forecast[station_id].items()}
+    return {'geocode': geocode, 'issue': '202401010300',
+            'stations': stations.to_dict('records'), 'forecast': forecast}
+
+
+def write(name: str, fixture: dict):
+    os.makedirs(FIXTURES, exist_ok=True)
+    path = os.path.join(FIXTURES, f'{name}.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(fixture, f, ensure_ascii=False, separators=(',', ':'))
+    print(f'wrote {path}')
+
+
+def main():
+    if sys.argv[1:] == ['synthetic']:
+        write('hafas', synthetic_hafas())
+        write('weather', synthetic_weather())
+        return
+    from pyhafas.client import HafasClient
+    from src.transport.ProductProfile import ProductProfile
+    write('hafas', record_hafas(HafasClient(profile=ProductProfile())))
+    weather = DWD(ApiKeys('config/api_keys.json'))
+    write('weather', record_weather(weather.geo, weather.client))
+
+
+if __name__ == '__main__':
+    main()
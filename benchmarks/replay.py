@@ -0,0 +1,197 @@
+""" stub clients replaying the recorded HAFAS, geocoder and MOSMIX
+responses in benchmarks/fixtures, they are injected into Hafas and DWD
+
+the fixtures are written by benchmarks/record_fixtures.py, times are
+stored relative to the request so that they can be replayed at any time
+"""
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from pyhafas.profile import DBProfile
+from pyhafas.types.fptf import Leg, Station, StationBoardLeg, Stopover
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+# lines of the synthetic departures, each with its own direction
+LINES = ['S 5', 'S 7', 'S 75', 'U 2', 'U 5', 'U 8', 'Bus 100', 'Bus 200',
+         'Bus 248', 'M4', 'M5', 'M6', 'RE 1', 'RB 23']
+DIRECTIONS = ['S Spandau Bhf (Berlin)', 'S Ahrensfelde Bhf (Berlin)',
+              'U Pankow (Berlin)', 'S+U Zoologischer Garten Bhf (Berlin)',
+              'Hackescher Markt (Berlin)', 'Brandenburg Hbf',
+              'Frankfurt (Oder), Bahnhof', 'S Wartenberg (Berlin)']
+PRODUCTS = ['suburban', 'subway', 'bus', 'tram', 'regional']
+
+
+def load_fixture(name: str) -> dict:
+    with open(os.path.join(FIXTURES, f'{name}.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def synthetic_departures(n: int, station: Station = None,
+                         rng: random.Random = None, platforms: float = 1.0,
+                         window: int = 180) -> list:
+    # n made-up departures within window minutes, a share platforms of
+    # them has a platform, with new string objects for every leg as
+    # parsed from a response
+    station = station or Station(id='8011155', name='Berlin Alexanderplatz')
+    rng = rng or random.Random(0)
+    start = DBProfile.timezone.localize(
+        datetime.now().replace(second=0, microsecond=0))
+    departures = []
+    for i in range(n):
+        line = rng.randrange(len(LINES))
+        delay = rng.choice([None, 0, 1, 2, 5, -1])
+        leg = StationBoardLeg(
+            id=f'1|{rng.randrange(10 ** 6)}|{i}|86|{start:%d%m%Y}',
+            name=''.join(LINES[line]),
+            direction=''.join(DIRECTIONS[(line + i % 2) % len(DIRECTIONS)]),
+            station=station,
+            date_time=start + timedelta(minutes=rng.randint(0, window)),
+            cancelled=rng.random() < 0.05,
+            delay=None if delay is None else timedelta(minutes=delay),
+            platform=str(rng.randint(1, 8))
+            if rng.random() < platforms else None
+        )
+        leg.product = PRODUCTS[line % len(PRODUCTS)]
+        departures.append(leg)
+    return departures
+
+
+class ReplayClient:
+    # counts the calls and optionally simulates the network latency
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, name: str):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+
+class ReplayHafasClient(ReplayClient):
+    # locations, departures and trip of pyhafas.HafasClient
+    def __init__(self, fixture: dict = None, latency: float = 0.0):
+        super().__init__(latency)
+        fixture = fixture or load_fixture('hafas')
+        self._locations = fixture['locations']
+        self._departures = fixture['departures']
+        self._routes = fixture['routes']
+        # the route of every recorded trip
+        self._trips = {}
+        for board in self._departures.values():
+            idx = board['columns'].index
+            for row in board['rows']:
+                self._trips[row[idx('id')]] = row[idx('route')]
+
+    def locations(self, term: str) -> list:
+        self._call('locations')
+        return [Station(id=s['id'], name=s['name'])
+                for s in self._locations.get(term, [])]
+
+    def departures(self, station, date: datetime, duration: int,
+                   max_trips: int = -1, products: dict = None) -> list:
+        self._call('departures')
+        if not isinstance(station, Station):
+            station = Station(id=station)
+        if date.tzinfo is None:
+            date = DBProfile.timezone.localize(date)
+        board = self._departures.get(station.id, {'columns': [], 'rows': []})
+        idx = board['columns'].index
+        departures = []
+        for row in board['rows']:
+            if row[idx('minutes')] > duration:
+                continue
+            delay = row[idx('delay')]
+            leg = StationBoardLeg(
+                id=row[idx('id')],
+                name=row[idx('name')],
+                direction=row[idx('direction')],
+                station=station,
+                date_time=date + timedelta(minutes=row[idx('minutes')]),
+                cancelled=row[idx('cancelled')],
+                delay=None if delay is None else timedelta(seconds=delay),
+                platform=row[idx('platform')]
+            )
+            # products as set by ProductProfile
+            leg.product = row[idx('product')] \
+                if 'product' in board['columns'] else None
+            departures.append(leg)
+        return departures
+
+    def trip(self, trip_id: str) -> Leg:
+        self._call('trip')
+        route = self._trips.get(trip_id)
+        if route is None:
+            raise KeyError(f'trip {trip_id} not recorded')
+        stops = [Station(id=stop_id) for stop_id in self._routes[route]]
+        now = datetime.now(DBProfile.timezone)
+        return Leg(id=trip_id, origin=stops[0], destination=stops[-1],
+                   departure=now, arrival=now,
+                   stopovers=[Stopover(stop=stop) for stop in stops])
+
+
+class ReplayGeocoder(ReplayClient):
+    # geocode of the geopy geocoders
+    def __init__(self, fixture: dict = None, latency: float = 0.0):
+        super().__init__(latency)
+        fixture = fixture or load_fixture('weather')
+        self._geocode = fixture['geocode']
+
+    def geocode(self, query: str, exactly_one: bool = True,
+                limit: int = None):
+        self._call('geocode')
+        results = [(address, tuple(latlon))
+                   for address, latlon in self._geocode.get(query, [])]
+        results = results[:limit] if limit else results
+        if exactly_one:
+            return results[0] if results else None
+        return results or None
+
+
+class ReplayMosmix(ReplayClient):
+    # issue_time, stations and forecast of src.weather.Mosmix
+    def __init__(self, fixture: dict = None, latency: float = 0.0):
+        super().__init__(latency)
+        fixture = fixture or load_fixture('weather')
+        self._issue = fixture['issue']
+        self._stations = pd.DataFrame(fixture['stations'])
+        self._forecast = fixture['forecast']
+
+    def issue_time(self) -> str:
+        self._call('issue_time')
+        return self._issue
+
+    def stations(self) -> pd.DataFrame:
+        self._call('stations')
+        return self._stations.copy()
+
+    def forecast(self, station_ids: list) -> pd.DataFrame:
+        # hourly values from the start of the current hour
+        self._call('forecast')
+        start = pd.Timestamp.now(tz='UTC').floor('h')
+        frames = []
+        for station_id in station_ids:
+            values = self._forecast.get(station_id, {})
+            for parameter, series in values.items():
+                frames.append(pd.DataFrame({
+                    'station_id': station_id,
+                    'dataset': 'small',
+                    'parameter': parameter,
+                    'date': pd.date_range(start, periods=len(series),
+                                          freq='h'),
+                    'value': np.array(series, dtype=float),
+                    'quality': np.nan
+                }))
+        if not frames:
+            return pd.DataFrame(columns=['station_id', 'dataset', 'parameter',
+                                         'date', 'value', 'quality'])
+        return pd.concat(frames, ignore_index=True)
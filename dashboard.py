@@ -1,30 +1,104 @@
+import hashlib
+import json
+import logging
 import os
-from datetime import datetime
+import threading
+from functools import partial
 import pytz
+import pandas as pd
 import dash_bootstrap_components as dbc
-from dash import Dash, html, dcc, Input, Output, State, clientside_callback
+from dash import Dash, html, dcc, Input, Output, State, ALL, \
+    clientside_callback, no_update
+from dash.exceptions import PreventUpdate
+from flask import Response, request
+from plotly.io.json import to_json_plotly
 
 from src.ApiKeys import ApiKeys
+from src.Cache import TTLCache
+from src.Metrics import metrics
+from src.Scheduler import Scheduler
 from src.transport.Hafas import Hafas
+from src.utils import Debouncer
 from src.weather.DWD import DWD
 
 # os.environ['TZ'] = 'Europe/Berlin'
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='time=%(asctime)s level=%(levelname)s logger=%(name)s '
+           'process=%(process)d %(message)s')
+log = logging.getLogger('dashboard')
 api_keys = ApiKeys('config/api_keys.json')
 
-# refresh rates
-CLOCK_REFRESH = 60 * 1000
+# refresh rates of the server-side data
 TRANSPORT_REFRESH = 60 * 1000
 WEATHER_REFRESH = 60 * 60 * 1000
 
+# new data is pushed to the clients (server-sent events), the browser
+# reads the received data and ticks the clock without calling the server
+CLOCK_REFRESH = 1000
+PUSH_READ = 1000
+# a pushing stream checks for changes at least this many seconds
+PUSH_HEARTBEAT = 15
+# every open stream holds a thread of its worker (32 in the container),
+# more streams are turned away so that the callbacks keep threads
+PUSH_MAX_STREAMS = int(os.getenv('PUSH_MAX_STREAMS', 16))
+# a browser that was turned away connects again after this many ms
+# and meanwhile polls the boards and the weather figure
+PUSH_RETRY = 60 * 1000
+POLL_REFRESH = TRANSPORT_REFRESH
+
+# departures are shared between sessions for this many seconds
+DEPARTURE_CACHE_TTL = TRANSPORT_REFRESH / 1000
+DEPARTURE_CACHE_SIZE = 512
+
+# stations are fetched concurrently in the background, a newly
+# subscribed station is waited for this many seconds
+SCHEDULER_WORKERS = 8
+TRANSPORT_TIMEOUT = 15
+WEATHER_TIMEOUT = 30
+
+# station searches wait this many seconds for the next keystroke
+SEARCH_DEBOUNCE = 0.3
+
 # set up dash and other global objects
 # https://hellodash.pythonanywhere.com/
 dbc_css = "assets/dbc.css"
 app = Dash(__name__, external_stylesheets=[dbc.themes.YETI, dbc_css])
-transport = Hafas()
+server = app.server  # WSGI entry point, e.g. gunicorn dashboard:server
+transport = Hafas(departure_ttl=DEPARTURE_CACHE_TTL,
+                  departure_cache_size=DEPARTURE_CACHE_SIZE)
 weather = DWD(api_keys)
+scheduler = Scheduler(workers=SCHEDULER_WORKERS)
+search_debouncer = Debouncer(delay=SEARCH_DEBOUNCE)
+# weather figures per forecast versions
+weather_figures = TTLCache(ttl=2 * WEATHER_REFRESH / 1000, maxsize=64)
+push_streams = set()  # open server-sent event streams
+push_lock = threading.Lock()
+
+
+@metrics.collector
+def collect_metrics():
+    # cache statistics and subscriptions at scrape time
+    caches = {'transport_' + k: v for k, v in transport.cache_stats().items()}
+    caches.update({'weather_' + k: v
+                   for k, v in weather.cache_stats().items()})
+    caches['weather_figures'] = weather_figures.stats()
+    for name in ['hits', 'misses', 'hit_ratio', 'size']:
+        for cache, stats in caches.items():
+            yield f'cache_{name}', {'cache': cache}, stats[name]
+    yield 'scheduler_jobs', {}, scheduler.jobs()
+    yield 'push_streams', {}, len(push_streams)
+
+
+@server.route('/metrics')
+def prometheus_metrics():
+    # metrics of the worker answering the scrape
+    return Response(metrics.render(), content_type='text/plain; '
+                    'version=0.0.4; charset=utf-8')
 
 # set up dash app layout
 app.layout = dbc.Container(fluid=True, className="dbc", children=[
+    dcc.Store(id='session', storage_type='session'),
     dbc.Row(children=[
         dbc.Col([
             html.Div(id='clock'),
@@ -73,19 +147,22 @@ app.layout = dbc.Container(fluid=True, className="dbc", children=[
                         ),
             ]),
             dbc.Row(id='transport_data'),
-            dcc.Interval(id='transport_refresh', n_intervals=0,
-                         interval=TRANSPORT_REFRESH),
         ]),
         dbc.Col(width=5, children=[
             dbc.Row(dcc.Dropdown(id='weather_locations', multi=True,
                                  search_value='Berlin',
                                  placeholder='Wetterstationen',
                                  persistence=True)),
-            dbc.Row(id='weather_data'),
-            dcc.Interval(id='weather_refresh', n_intervals=0,
-                         interval=WEATHER_REFRESH),
+            dbc.Row(id='weather_data', children=dcc.Graph(
+                id='weather', style={'display': 'none'})),
+            dcc.Store(id='weather_figure'),
+            dcc.Store(id='plotly_templates', data=weather.templates()),
         ])
-    ])
+    ]),
+    dcc.Store(id='push'),
+    dcc.Interval(id='push_read', n_intervals=0, interval=PUSH_READ),
+    dcc.Interval(id='poll', n_intervals=0, interval=POLL_REFRESH,
+                 disabled=True),
 ])
 
 clientside_callback(
@@ -101,22 +178,211 @@ clientside_callback(
     Input("switch", "value"),
 )
 
+# the theme-free weather figure gets its template in the browser
+clientside_callback(
+    """
+    (switchOn, figure, templates) => {
+       if (!figure) {
+         return [{}, {'display': 'none'}]
+       }
+       const template = switchOn ? templates.light : templates.dark
+       return [{...figure, layout: {...figure.layout, template: template}},
+               {'height': '85vh'}]
+    }
+    """,
+    Output('weather', 'figure'),
+    Output('weather', 'style'),
+    Input('switch', 'value'),
+    Input('weather_figure', 'data'),
+    State('plotly_templates', 'data'),
+)
 
-@app.callback(
+# random id per browser tab
+clientside_callback(
+    """
+    (_, session) => session || Math.random().toString(36).slice(2)
+    """,
+    Output('session', 'data'),
+    Input('session', 'id'),
+    State('session', 'data'),
+)
+
+
+# the clock ticks in the browser
+clientside_callback(
+    """
+    (_) => new Date().toLocaleTimeString(
+        'de-DE', {hour: '2-digit', minute: '2-digit'}) + ' Uhr'
+    """,
     Output('clock', 'children'),
-    Input('clock_refresh', 'n_intervals')
+    Input('clock_refresh', 'n_intervals'),
+)
+
+# (re-)connect to the pushing stream of the selected stations,
+# the received data is buffered until push_read picks it up
+clientside_callback(
+    """
+    (transport, n_rows, timedelta, weather, session) => {
+       const push = window.dashboardPush = window.dashboardPush ||
+         {source: null, transport: {}, weather: null}
+       if (push.source) {
+         push.source.close()
+         push.source = null
+       }
+       clearTimeout(push.retry)
+       push.polling = false
+       push.transport = {}
+       push.weather = null
+       transport = transport || []
+       weather = weather || []
+       if (!session || (!transport.length && !weather.length)) {
+         return ''
+       }
+       const params = new URLSearchParams({session: session,
+         n_rows: n_rows || 15, timedelta: timedelta || 0})
+       transport.forEach(name => params.append('transport', name))
+       weather.forEach(name => params.append('weather', name))
+       const connect = () => {
+         const source = push.source =
+           new EventSource('events?' + params.toString())
+         source.addEventListener('transport', (e) => {
+           Object.assign(push.transport, JSON.parse(e.data))
+         })
+         source.addEventListener('weather', (e) => {
+           push.weather = JSON.parse(e.data)
+         })
+         source.onopen = () => {
+           push.polling = false
+         }
+         // a stream turned away by a busy server is not reconnected by
+         // the browser, the data is polled until the next try succeeds
+         source.onerror = () => {
+           if (source.readyState === EventSource.CLOSED &&
+               push.source === source) {
+             push.polling = true
+             push.retry = setTimeout(connect,
+                                     PUSH_RETRY * (1 + Math.random()))
+           }
+         }
+       }
+       connect()
+       return params.toString()
+    }
+    """.replace('PUSH_RETRY', str(PUSH_RETRY)),
+    Output('push', 'data'),
+    Input('transport_locations', 'value'),
+    Input('n_rows', 'value'),
+    Input('timedelta', 'value'),
+    Input('weather_locations', 'value'),
+    Input('session', 'data'),
+)
+
+# tables of stations which are not shown yet stay in the buffer
+clientside_callback(
+    """
+    (_, ids) => {
+       const push = window.dashboardPush
+       const noUpdate = window.dash_clientside.no_update
+       let changed = false
+       const data = ids.map(() => noUpdate)
+       const titles = ids.map(() => noUpdate)
+       let figure = noUpdate
+       if (push) {
+         ids.forEach((id, i) => {
+           const board = push.transport[id.index]
+           if (board) {
+             data[i] = board.data
+             titles[i] = board.title
+             delete push.transport[id.index]
+             changed = true
+           }
+         })
+         if (push.weather) {
+           figure = push.weather
+           push.weather = null
+           changed = true
+         }
+       }
+       if (!changed) {
+         throw window.dash_clientside.PreventUpdate
+       }
+       return [data, titles, figure]
+    }
+    """,
+    Output({'type': 'transport_table', 'index': ALL}, 'data'),
+    Output({'type': 'transport_title', 'index': ALL}, 'children'),
+    Output('weather_figure', 'data', allow_duplicate=True),
+    Input('push_read', 'n_intervals'),
+    State({'type': 'transport_table', 'index': ALL}, 'id'),
+    prevent_initial_call=True,
+)
+
+
+# polling only while the stream is turned away
+clientside_callback(
+    """
+    (_, disabled) => {
+       const push = window.dashboardPush
+       const polling = Boolean(push && push.polling)
+       return polling === !disabled ? window.dash_clientside.no_update
+                                    : !polling
+    }
+    """,
+    Output('poll', 'disabled'),
+    Input('push_read', 'n_intervals'),
+    State('poll', 'disabled'),
+)
+
+
+@app.callback(
+    Output({'type': 'transport_table', 'index': ALL}, 'data',
+           allow_duplicate=True),
+    Output({'type': 'transport_title', 'index': ALL}, 'children',
+           allow_duplicate=True),
+    Output('weather_figure', 'data', allow_duplicate=True),
+    Input('poll', 'n_intervals'),
+    State({'type': 'transport_table', 'index': ALL}, 'id'),
+    State('weather_locations', 'value'),
+    State('session', 'data'),
+    State('n_rows', 'value'),
+    State('timedelta', 'value'),
+    prevent_initial_call=True,
 )
-def update_clock(_):
-    return datetime.now().strftime('%H:%M') + ' Uhr'
+def poll_data(_, ids, weather_locations, session, n_rows, timedelta):
+    # what push_events would send, for browsers without a stream
+    if session is None:
+        raise PreventUpdate
+    names = [table['index'] for table in ids]
+    transport.update_locations(names, subscriber=session)
+    boards = get_transport_boards(names, n_rows, timedelta)
+    data = [records for records, _ in boards]
+    titles = [transport.table_title(name, message)
+              for name, (_, message) in zip(names, boards)]
+    figure = no_update
+    if weather_locations:
+        weather.update_locations(weather_locations, subscriber=session)
+        keys = subscribe_weather(weather_locations)
+        scheduler.wait(keys, timeout=WEATHER_TIMEOUT)
+        figure = get_weather_figure(keys) or no_update
+    return data, titles, figure
 
 
 # public transport callbacks
 @app.callback(
     Output('transport_locations', 'options'),
     [Input('transport_locations', 'search_value')],
-    [State('transport_locations', 'value')]
+    [State('transport_locations', 'value'),
+     State('session', 'data')]
 )
-def find_transport_locations(search, selected, max_new_locations=5):
+def find_transport_locations(search, selected, session,
+                             max_new_locations=5):
+    # known stations are answered right away, otherwise only the last
+    # search of a session within the debounce delay asks hafas, the
+    # first search of a tab runs before the session store is filled
+    if session is not None and \
+            not transport.knows_locations(search, max_new_locations) and \
+            not search_debouncer(session):
+        raise PreventUpdate
     new_station_names = transport.find_locations(search, max_new_locations)
     if selected:
         return selected + new_station_names
@@ -127,34 +393,21 @@ def find_transport_locations(search, selected, max_new_locations=5):
 @app.callback(
     Output('transport_data', 'children'),
     [Input('transport_locations', 'value'),
-     Input('n_rows', 'value'),
-     Input('timedelta', 'value'),
-     Input("switch", "value"),
-     Input('transport_refresh', 'n_intervals')]
+     Input('session', 'data')],
+    [State('n_rows', 'value'),
+     State('timedelta', 'value')]
 )
-def get_transport_data(locations, n_rows, timedelta, light_mode, _):
+def get_transport_tables(locations, session, n_rows, timedelta):
+    # the tables are only created when the selection changes,
+    # push_events keeps their data up to date, the session store is
+    # filled in the browser and might still be empty at the first call
+    if session is None:
+        raise PreventUpdate
     if locations:
-        transport.update_locations(locations)
-        tables = []
-        for name in locations:
-            print(f'updating transport data for {name} ...')
-            # workaround right now, should have a checkbox
-            # for products here for each station
-            if '(S)' in name:
-                products = ['S']
-            elif '(U)' in name:
-                products = ['U']
-            elif '(S+U)' in name:
-                products = ['S', 'U']
-            else:
-                products = transport.products.keys()
-
-            df = transport.get_data(name=name, products=products,
-                                    n_rows=int(n_rows), timedelta=timedelta)
-            table = transport.data_to_table(df, name, light_mode=light_mode)
-
-            # add to dashboard
-            tables.append(table)
+        transport.update_locations(locations, subscriber=session)
+        boards = get_transport_boards(locations, n_rows, timedelta)
+        tables = [transport.make_table(name, records, message)
+                  for name, (records, message) in zip(locations, boards)]
 
         # make it two columns
         if len(tables) > 0:
@@ -171,6 +424,60 @@ def get_transport_data(locations, n_rows, timedelta, light_mode, _):
         return
 
 
+def get_transport_boards(names: list, n_rows, timedelta) -> list:
+    # records and status message of each station from the newest snapshots
+    keys = subscribe_transport(names, n_rows, timedelta)
+    # only new stations have to be waited for
+    scheduler.wait(keys, timeout=TRANSPORT_TIMEOUT)
+    return [transport_board(key) for key in keys]
+
+
+def subscribe_transport(names: list, n_rows, timedelta) -> list:
+    keys = []
+    for name in names:
+        key = ('transport', name, int(n_rows), timedelta)
+        scheduler.subscribe(
+            key, partial(fetch_transport_data, name=name,
+                         n_rows=int(n_rows), timedelta=timedelta),
+            interval=TRANSPORT_REFRESH / 1000)
+        keys.append(key)
+    return keys
+
+
+def transport_board(key: tuple) -> tuple:
+    snapshot = scheduler.snapshot(key)
+    if snapshot.data is None:
+        message = 'keine Daten' if snapshot.error else 'Zeitüberschreitung'
+        return [], message
+    message = 'veraltet' if scheduler.is_stale(key) else None
+    return transport.data_to_records(snapshot.data), message
+
+
+def board_digest(records: list, message: str) -> str:
+    return hashlib.sha1(
+        json.dumps([records, message], sort_keys=True).encode()).hexdigest()
+
+
+def fetch_transport_data(name: str, n_rows: int, timedelta: int):
+    log.info('updating transport data location=%r', name)
+    return transport.get_data(name=name, products=station_products(name),
+                              n_rows=n_rows, timedelta=timedelta)
+
+
+def station_products(name: str) -> list:
+    # workaround right now, should have a checkbox
+    # for products here for each station
+    if '(S)' in name:
+        products = ['S']
+    elif '(U)' in name:
+        products = ['U']
+    elif '(S+U)' in name:
+        products = ['S', 'U']
+    else:
+        products = transport.products.keys()
+    return products
+
+
 # def get_products(name: str) -> list:
 #     # checklist of types of transportation
 #     checklist = dbc.Checklist(id='products {name}',
@@ -197,22 +504,147 @@ def find_weather_locations(search, selected, max_new_locations=5):
 
 
 @app.callback(
-    Output('weather_data', 'children'),
+    Output('weather_figure', 'data'),
     [Input('weather_locations', 'value'),
-     Input("switch", "value"),
-     Input('weather_refresh', 'n_intervals')]
+     Input('session', 'data')]
 )
-def get_weather_data(locations, switch, _):
+def get_weather_data(locations, session):
+    # the figure is created when the selection changes,
+    # push_events keeps it up to date (see get_transport_tables)
+    if session is None:
+        raise PreventUpdate
     if locations:
-        weather.update_locations(locations)
-        print(f'updating weather data for {locations} ...')
-        df = weather.get_data(locations)
-        graph = weather.data_to_graph(df, name='weather', light_mode=switch)
-        return graph
+        weather.update_locations(locations, subscriber=session)
+        keys = subscribe_weather(locations)
+        scheduler.wait(keys, timeout=WEATHER_TIMEOUT)
+
+        return get_weather_figure(keys)
     else:
         return
 
 
+def subscribe_weather(names: list) -> list:
+    keys = []
+    for name in names:
+        key = ('weather', name)
+        scheduler.subscribe(key, partial(fetch_weather_data, name),
+                            interval=WEATHER_REFRESH / 1000)
+        keys.append(key)
+    return keys
+
+
+def get_weather_figure(keys: list) -> dict:
+    # figures are shared by all sessions with the same locations,
+    # the version changes with every refresh of one of the forecasts
+    keys = sorted(keys)
+    version = tuple((key, scheduler.snapshot(key).updated) for key in keys)
+    figure = weather_figures.get(version)
+    if figure is None:
+        forecasts = [scheduler.snapshot(key).data for key in keys]
+        forecasts = [df for df in forecasts if df is not None]
+        if len(forecasts) == 0:
+            return
+        # locations can share the same weather station
+        df = pd.concat(forecasts, ignore_index=True).drop_duplicates(
+            subset=['station_id', 'date'])
+        figure = weather.data_to_figure(df)
+        weather_figures.set(version, figure)
+    return figure
+
+
+def fetch_weather_data(name: str):
+    log.info('updating weather data location=%r', name)
+    return weather.get_data([name])
+
+
+@server.route('/events')
+def events():
+    # server-sent events with the changed boards and weather figures
+    # of the stations given in the query, each open stream takes one
+    # thread of the server, beyond PUSH_MAX_STREAMS the browser is
+    # turned away and tries again later
+    stream = object()
+    with push_lock:
+        accepted = len(push_streams) < PUSH_MAX_STREAMS
+        if accepted:
+            push_streams.add(stream)
+    if not accepted:
+        metrics.count('push_rejected_total')
+        return Response('too many open streams', status=503,
+                        headers={'Retry-After': str(PUSH_RETRY // 1000)})
+
+    def close():
+        with push_lock:
+            push_streams.discard(stream)
+
+    args = request.args
+    response = Response(
+        push_events(session=args.get('session'),
+                    transport_names=args.getlist('transport'),
+                    weather_names=args.getlist('weather'),
+                    n_rows=args.get('n_rows', 15, type=int),
+                    timedelta=args.get('timedelta', 0, type=int)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # also if the stream is closed before it started
+    response.call_on_close(close)
+    return response
+
+
+def push_events(session: str, transport_names: list, weather_names: list,
+                n_rows: int, timedelta: int):
+    # everything is sent once after (re-)connecting, afterwards only
+    # what changed, the scheduler wakes the stream after every refresh
+    seen = {}  # key: state of the snapshot when it was last looked at
+    sent = {}  # station name: digest of the last sent board
+    yield 'retry: 5000\n\n'
+    while True:
+        version = scheduler.version
+        # renew the subscriptions while the stream is open
+        transport.update_locations(transport_names, subscriber=session)
+        weather.update_locations(weather_names, subscriber=session)
+        transport_keys = subscribe_transport(transport_names, n_rows,
+                                             timedelta)
+        weather_keys = subscribe_weather(weather_names)
+
+        boards = {}
+        for name, key in zip(transport_names, transport_keys):
+            snapshot = scheduler.snapshot(key)
+            if snapshot.updated == 0 and snapshot.error is None:
+                continue  # not fetched yet
+            state = (snapshot.updated, snapshot.error is not None,
+                     scheduler.is_stale(key))
+            if seen.get(key) == state:
+                continue
+            seen[key] = state
+            records, message = transport_board(key)
+            digest = board_digest(records, message)
+            if sent.get(name) != digest:
+                sent[name] = digest
+                boards[name] = {
+                    'data': records,
+                    'title': transport.table_title(name, message)}
+        if boards:
+            metrics.count('push_events_total', kind='transport')
+            yield f'event: transport\ndata: {to_json_plotly(boards)}\n\n'
+
+        if weather_keys:
+            state = tuple(scheduler.snapshot(key).updated
+                          for key in sorted(weather_keys))
+            if seen.get('weather') != state:
+                seen['weather'] = state
+                figure = get_weather_figure(weather_keys)
+                if figure is not None:
+                    metrics.count('push_events_total', kind='weather')
+                    yield f'event: weather\ndata: ' \
+                          f'{to_json_plotly(figure)}\n\n'
+
+        # the comment keeps the connection open and lets a closed
+        # one fail, the stale flags depend on the time as well
+        yield ': heartbeat\n\n'
+        version = scheduler.wait_changed(version, PUSH_HEARTBEAT)
+
+
 def chunks(data: list, columns: int) -> list:
     # split 1-D array in a certain number of 2-D array
     data_out = []
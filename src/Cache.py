@@ -0,0 +1,229 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# local directory for persistent caches
+CACHE_DIR = os.getenv('CACHE_DIR', 'cache')
+# where the caches live, see make_cache
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'local')
+CACHE_URL = os.getenv('CACHE_URL', 'redis://localhost:6379/0')
+
+_missing = object()
+
+
+class TTLCache:
+    """ thread-safe in-memory cache with time-to-live and LRU eviction """
+
+    def __init__(self, ttl: float = 60, maxsize: int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key: (expiry timestamp, value)
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] < time.time():
+                # expired entries are dropped on access
+                self._data.pop(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._store(key, value, time.time() + ttl)
+
+    def _store(self, key, value, expires: float):
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            # evict least recently used entries
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests > 0 else 0.0,
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl
+        }
+
+
+class SqliteCache(TTLCache):
+    """ TTLCache that writes through to a SQLite file and is warm-loaded
+    from it at startup, values have to be picklable """
+
+    def __init__(self, path: str, ttl: float = 60, maxsize: int = 256):
+        super().__init__(ttl=ttl, maxsize=maxsize)
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None, timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache '
+                         '(key BLOB PRIMARY KEY, expires REAL, value BLOB)')
+        self._writes = 0
+        self._load()
+
+    def _load(self):
+        # warm up the memory with the most recent entries
+        with self._lock:
+            self._prune()
+            rows = self._db.execute(
+                'SELECT key, expires, value FROM cache '
+                'ORDER BY expires ASC LIMIT -1 OFFSET MAX(0, '
+                '(SELECT COUNT(*) FROM cache) - ?)', (self.maxsize,))
+            for key, expires, value in rows.fetchall():
+                super()._store(pickle.loads(key), pickle.loads(value),
+                               expires)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = super().get(key, _missing)
+            if value is _missing:
+                # another process might have stored it in the meantime
+                row = self._db.execute(
+                    'SELECT expires, value FROM cache '
+                    'WHERE key = ? AND expires >= ?',
+                    (pickle.dumps(key), time.time())).fetchone()
+                if row is None:
+                    return default
+                self.misses -= 1
+                self.hits += 1
+                value = pickle.loads(row[1])
+                super()._store(key, value, row[0])
+            return value
+
+    def _store(self, key, value, expires: float):
+        with self._lock:
+            super()._store(key, value, expires)
+            self._db.execute(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                (pickle.dumps(key), expires, pickle.dumps(value)))
+            # keep the file bounded as well
+            self._writes += 1
+            if self._writes % (self.maxsize // 10 + 1) == 0:
+                self._prune()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self._db.execute('DELETE FROM cache WHERE key = ?',
+                             (pickle.dumps(key),))
+            return super().pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM cache')
+            super().clear()
+
+    def _prune(self):
+        self._db.execute('DELETE FROM cache WHERE expires < ?',
+                         (time.time(),))
+        self._db.execute(
+            'DELETE FROM cache WHERE key NOT IN '
+            '(SELECT key FROM cache ORDER BY expires DESC LIMIT ?)',
+            (self.maxsize,))
+
+
+class RedisCache(TTLCache):
+    """ cache in a Redis compatible server shared by several processes,
+    a sorted set of access times per cache name implements the LRU """
+
+    def __init__(self, name: str, ttl: float = 60, maxsize: int = 256,
+                 client=None, url: str = CACHE_URL):
+        super().__init__(ttl=ttl, maxsize=maxsize)
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError('the redis cache backend needs the redis '
+                                  'package: pip install redis')
+            client = redis.Redis.from_url(url)
+        self._client = client
+        self._prefix = f'{name}:'.encode()
+        self._lru = f'{name}:lru'.encode()
+
+    def get(self, key, default=None):
+        redis_key = self._redis_key(key)
+        value = self._client.get(redis_key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        self._client.zadd(self._lru, {redis_key: time.time()})
+        return pickle.loads(value)
+
+    def _store(self, key, value, expires: float):
+        redis_key = self._redis_key(key)
+        ttl = max(int((expires - time.time()) * 1000), 1)
+        self._client.set(redis_key, pickle.dumps(value), px=ttl)
+        self._client.zadd(self._lru, {redis_key: time.time()})
+        # evict least recently used entries
+        overflow = self._client.zcard(self._lru) - self.maxsize
+        if overflow > 0:
+            evicted = [k for k, _ in self._client.zpopmin(self._lru, overflow)]
+            self._client.delete(*evicted)
+
+    def pop(self, key, default=None):
+        redis_key = self._redis_key(key)
+        value = self._client.get(redis_key)
+        self._client.delete(redis_key)
+        self._client.zrem(self._lru, redis_key)
+        return default if value is None else pickle.loads(value)
+
+    def clear(self):
+        keys = self._client.zrange(self._lru, 0, -1)
+        if keys:
+            self._client.delete(*keys)
+        self._client.delete(self._lru)
+
+    def __len__(self):
+        # expired keys are only removed from the lru set on eviction
+        return self._client.zcard(self._lru)
+
+    def _redis_key(self, key) -> bytes:
+        return self._prefix + pickle.dumps(key)
+
+
+def make_cache(name: str, ttl: float = 60, maxsize: int = 256,
+               persistent: bool = False) -> TTLCache:
+    """ cache of the configured CACHE_BACKEND:
+    local: persistent caches in SQLite files, the others in memory
+    memory: all caches in memory of the process
+    sqlite: all caches in SQLite files shared by the local processes
+    redis: all caches in the Redis server at CACHE_URL """
+    if CACHE_BACKEND == 'redis':
+        return RedisCache(name, ttl=ttl, maxsize=maxsize)
+    if CACHE_BACKEND == 'sqlite' or (CACHE_BACKEND == 'local' and persistent):
+        return SqliteCache(os.path.join(CACHE_DIR, f'{name}.sqlite'),
+                           ttl=ttl, maxsize=maxsize)
+    if CACHE_BACKEND in ('local', 'memory'):
+        return TTLCache(ttl=ttl, maxsize=maxsize)
+    raise ValueError(f'unknown cache backend {CACHE_BACKEND}')
@@ -1,10 +1,20 @@
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import Counter
 
 
 class LocationData(ABC):
 
-    def __init__(self):
+    def __init__(self, subscriber_expiry: float = 15 * 60):
         self._locations = {}  # internal storage of station information
+        # locations selected per subscriber (e.g. browser tab) and the
+        # number of subscribers per location, subscribers that did not
+        # update their selection for subscriber_expiry seconds are dropped
+        self.subscriber_expiry = subscriber_expiry
+        self._subscribers = {}  # subscriber: (names, last update)
+        self._refcounts = Counter()
+        self._lock = threading.RLock()
 
     @abstractmethod
     def find_locations(self, name, number):
@@ -14,13 +24,49 @@ class LocationData(ABC):
     def get_data(self, name):
         pass
 
-    def update_locations(self, names):
-        # delete extra stations
-        superfluous_locations = set(self._locations.keys()) - set(names)
-        for name in superfluous_locations:
-            self._locations.pop(name)
+    def update_locations(self, names, subscriber=None):
+        with self._lock:
+            now = time.time()
+            self._unsubscribe(subscriber)
+            self._subscribers[subscriber] = (set(names), now)
+            self._refcounts.update(set(names))
+            for expired in [s for s, (_, updated) in self._subscribers.items()
+                            if updated < now - self.subscriber_expiry]:
+                self._unsubscribe(expired)
 
-        # get missing stations
-        missing_locations = set(names) - set(self._locations.keys())
+            # delete stations nobody is subscribed to
+            superfluous_locations = set(self._locations.keys()) - \
+                set(self._refcounts.keys())
+            for name in superfluous_locations:
+                self._locations.pop(name)
+
+            # get missing stations
+            missing_locations = set(names) - set(self._locations.keys())
+
+        # outside of the lock, this might ask the upstream service
         for name in missing_locations:
             self.find_locations(name=name, number=1)
+
+    def get_location(self, name):
+        # locations of other workers or expired subscribers are looked up
+        # again instead of failing
+        with self._lock:
+            location = self._locations.get(name)
+        if location is None:
+            self.find_locations(name=name, number=1)
+            with self._lock:
+                location = self._locations.get(name)
+            if location is None:
+                raise KeyError(f'location {name} not found')
+        return location
+
+    def _add_locations(self, locations: dict):
+        with self._lock:
+            self._locations.update(locations)
+
+    def _unsubscribe(self, subscriber):
+        names, _ = self._subscribers.pop(subscriber, (set(), 0.0))
+        self._refcounts.subtract(names)
+        for name in names:
+            if self._refcounts[name] <= 0:
+                del self._refcounts[name]
@@ -0,0 +1,152 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0)
+
+
+class Timer:
+    elapsed: float = 0.0  # seconds, set when the timed block is left
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """ counters and timing histograms of the running process, rendered
+    in the Prometheus text format, each gunicorn worker has its own """
+
+    def __init__(self, prefix: str = 'dashboard_',
+                 buckets: tuple = BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._counters = defaultdict(float)  # (name, labels): value
+        self._histograms = {}  # (name, labels): Histogram
+        self._collectors = []  # callables returning gauges
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[(name, self._labels(labels))] += value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        # duration of the block, also if it raised
+        timer = Timer()
+        start = time.perf_counter()
+        try:
+            yield timer
+        finally:
+            timer.elapsed = time.perf_counter() - start
+            self.observe(name, timer.elapsed, **labels)
+
+    def timed(self, name: str, **labels) -> Callable:
+        # decorator version of timer
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def upstream(self, service: str, call: str):
+        # duration and outcome of a call to an upstream service
+        outcome = 'error'
+        try:
+            with self.timer('upstream_seconds', service=service, call=call):
+                yield
+            outcome = 'ok'
+        finally:
+            self.count('upstream_calls_total', service=service, call=call,
+                       outcome=outcome)
+
+    def collector(self, collect: Callable):
+        # collect() returns (name, labels, value) gauges at scrape time
+        self._collectors.append(collect)
+        return collect
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(h.counts), h.sum, h.count))
+                for key, h in self._histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            name = self._name(name)
+            self._type(lines, typed, name, 'counter')
+            lines.append(f'{name}{self._format(labels)} {value:g}')
+
+        for (name, labels), (counts, total, count) in histograms:
+            name = self._name(name)
+            self._type(lines, typed, name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                le = labels + (('le', f'{bound:g}' if bound != '+Inf'
+                                else bound),)
+                lines.append(f'{name}_bucket{self._format(le)} {cumulative}')
+            lines.append(f'{name}_sum{self._format(labels)} {total:g}')
+            lines.append(f'{name}_count{self._format(labels)} {count}')
+
+        for collect in self._collectors:
+            for name, labels, value in collect():
+                name = self._name(name)
+                self._type(lines, typed, name, 'gauge')
+                labels = self._labels(labels)
+                lines.append(f'{name}{self._format(labels)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def _format(labels: tuple) -> str:
+        if not labels:
+            return ''
+        escaped = (v.replace('\\', '\\\\').replace('"', '\\"')
+                   .replace('\n', '\\n') for _, v in labels)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in
+                              zip(labels, escaped)) + '}'
+
+    @staticmethod
+    def _type(lines: list, typed: set, name: str, kind: str):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} {kind}')
+
+    def _name(self, name: str) -> str:
+        return self.prefix + name
+
+
+# metrics of this process, shared by all modules
+metrics = Metrics()
@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from src.Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class Snapshot:
+    data: Any = None  # result of the last successful refresh
+    updated: float = 0.0  # time of the last successful refresh
+    error: Exception = None  # error of the last refresh, if it failed
+
+
+@dataclass
+class Job:
+    key: tuple
+    fetch: Callable
+    interval: float
+    last_seen: float = 0.0
+    next_run: float = 0.0
+    running: bool = False
+    snapshot: Snapshot = field(default_factory=Snapshot)
+    ready: threading.Event = field(default_factory=threading.Event)
+
+
+class Scheduler:
+    """ refreshes the data subscribed by the clients in the background and
+    keeps the newest snapshot of each subscription """
+
+    def __init__(self, workers: int = 8):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._thread = None
+        # counts the refreshes, waiters are notified of every refresh
+        self._version = 0
+        self._changed = threading.Condition()
+
+    def subscribe(self, key: tuple, fetch: Callable, interval: float):
+        # (re-)register a subscription, it is dropped when nobody asked
+        # for it during three refresh intervals
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                job = Job(key=key, fetch=fetch, interval=interval)
+                self._jobs[key] = job
+                self._wakeup.set()
+            job.last_seen = time.time()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='scheduler', daemon=True)
+                self._thread.start()
+
+    def snapshot(self, key: tuple) -> Snapshot:
+        job = self._jobs.get(key)
+        return job.snapshot if job is not None else Snapshot()
+
+    def is_stale(self, key: tuple) -> bool:
+        # the last successful refresh is more than two intervals old
+        job = self._jobs.get(key)
+        if job is None:
+            return True
+        return job.snapshot.updated < time.time() - 2 * job.interval
+
+    def wait(self, keys: list, timeout: float) -> bool:
+        # wait until all subscriptions have been fetched at least once
+        deadline = time.time() + timeout
+        for key in keys:
+            job = self._jobs.get(key)
+            if job is not None and not job.ready.wait(
+                    max(0.0, deadline - time.time())):
+                return False
+        return True
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def wait_changed(self, version: int, timeout: float) -> int:
+        # wait until a refresh after version or the timeout,
+        # returns the current version
+        with self._changed:
+            self._changed.wait_for(lambda: self._version != version,
+                                   timeout=timeout)
+            return self._version
+
+    def _run(self):
+        while True:
+            now = time.time()
+            with self._lock:
+                for key, job in list(self._jobs.items()):
+                    if job.last_seen < now - 3 * job.interval:
+                        self._jobs.pop(key)
+                    elif not job.running and job.next_run <= now:
+                        job.running = True
+                        self._pool.submit(self._refresh, job)
+                next_run = min([job.next_run for job in self._jobs.values()
+                                if not job.running], default=now + 1.0)
+            self._wakeup.wait(timeout=min(max(next_run - now, 0.1), 1.0))
+            self._wakeup.clear()
+
+    def jobs(self) -> int:
+        return len(self._jobs)
+
+    def _refresh(self, job: Job):
+        # the first element of the key tells the kind of data
+        kind = job.key[0] if isinstance(job.key, tuple) else job.key
+        outcome = 'error'
+        try:
+            with metrics.timer('refresh_seconds', kind=kind):
+                job.snapshot = Snapshot(job.fetch(), time.time())
+            outcome = 'ok'
+            log.debug('refreshed key=%r', job.key)
+        except Exception as e:
+            log.warning('refreshing failed key=%r error=%r', job.key, e)
+            job.snapshot = Snapshot(job.snapshot.data, job.snapshot.updated,
+                                    e)
+        finally:
+            metrics.count('refreshes_total', kind=kind, outcome=outcome)
+            job.next_run = time.time() + job.interval
+            job.running = False
+            job.ready.set()
+            with self._changed:
+                self._version += 1
+                self._changed.notify_all()
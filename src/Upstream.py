@@ -0,0 +1,195 @@
+import logging
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from typing import Callable
+
+from src.Cache import TTLCache
+from src.Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# errors of the service itself, matched by class name as the clients
+# (requests, aiohttp, geopy, pyhafas) are imported lazily
+OUTAGE_ERRORS = {
+    'ConnectionError', 'TimeoutError', 'Timeout',  # builtin, requests
+    'ClientConnectionError', 'ServerTimeoutError',  # aiohttp
+    'GeocoderUnavailable', 'GeocoderTimedOut', 'GeocoderRateLimited',
+    'GeneralHafasError',  # HAFAS internal errors and unparsable responses
+    'JSONDecodeError',  # an error page instead of the response
+}
+
+
+def is_outage(e: BaseException) -> bool:
+    """ whether e is a failure of the service (connection, timeout, 5xx)
+    rather than of the single request (an unknown trip, a 4xx) """
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    if status is None:
+        status = getattr(e, 'status', None)  # aiohttp
+    if isinstance(status, int):
+        return status >= 500 or status == 429
+    return any(cls.__name__ in OUTAGE_ERRORS for cls in type(e).__mro__)
+
+
+class Upstream:
+    """ calls of one upstream service (HAFAS, DWD, the geocoder)
+
+    identical concurrent calls are coalesced into one, calls failed by an
+    outage of the service (is_outage) are retried with jittered
+    exponential backoff, after failure_threshold outages in a row the
+    circuit opens and calls fail fast for reset_timeout seconds until one
+    trial call is let through, and while the service is out the last good
+    result of a call is served; errors of a single request are raised
+    right away """
+
+    def __init__(self, service: str, retries: int = 2,
+                 backoff: float = 0.25, max_backoff: float = 2.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30,
+                 stale_ttl: float = 60 * 60, stale_size: int = 1024):
+        self.service = service
+        self.retries = retries
+        self.backoff = backoff  # s, doubled for every retry
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._inflight = {}  # (call, key): Future of the leading caller
+        self._stale = TTLCache(ttl=stale_ttl, maxsize=stale_size)
+        self._failures = 0  # failures in a row
+        self._open_until = 0.0
+        self._probing = False  # a trial call of the half open circuit
+        self._lock = threading.Lock()
+        _upstreams.add(self)
+
+    def call(self, name: str, key, fetch: Callable, stale_key=None):
+        # key identifies identical calls, stale_key the calls whose last
+        # good result may stand in (default key)
+        flight = (name, key)
+        with self._lock:
+            future = self._inflight.get(flight)
+            leader = future is None
+            if leader:
+                future = self._inflight[flight] = Future()
+        if not leader:
+            metrics.count('upstream_coalesced_total', service=self.service,
+                          call=name)
+            return future.result()
+
+        try:
+            result = self._call(name, key if stale_key is None
+                                else stale_key, fetch)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(flight, None)
+
+    def state(self) -> str:
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return 'closed'
+            if self._probing or time.time() >= self._open_until:
+                return 'half_open'
+            return 'open'
+
+    def _call(self, name: str, stale_key, fetch: Callable):
+        try:
+            result = self._attempt(name, fetch)
+        except Exception as e:
+            result = None
+            if isinstance(e, CircuitOpenError) or is_outage(e):
+                result = self._stale.get((name, stale_key))
+            if result is None:
+                raise
+            log.warning('serving stale result service=%s call=%s error=%r',
+                        self.service, name, e)
+            metrics.count('upstream_stale_total', service=self.service,
+                          call=name)
+            return result
+        self._stale.set((name, stale_key), result)
+        return result
+
+    def _attempt(self, name: str, fetch: Callable):
+        attempt = 0
+        while True:
+            self._before_call(name)
+            try:
+                with metrics.upstream(self.service, name):
+                    result = fetch()
+            except Exception as e:
+                if not is_outage(e):
+                    # the service answered, the request itself failed
+                    self._answered()
+                    raise
+                if not self._failure() or attempt >= self.retries:
+                    raise
+                # full jitter, concurrent callers do not retry in step
+                delay = random.uniform(
+                    0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                log.info('retrying service=%s call=%s attempt=%d '
+                         'delay=%.2f error=%r', self.service, name,
+                         attempt + 1, delay, e)
+                metrics.count('upstream_retries_total', service=self.service,
+                              call=name)
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self._success()
+                return result
+
+    def _before_call(self, name: str):
+        with self._lock:
+            if self._failures < self.failure_threshold:
+                return
+            if not self._probing and time.time() >= self._open_until:
+                self._probing = True
+                return
+        metrics.count('upstream_rejected_total', service=self.service,
+                      call=name)
+        raise CircuitOpenError(f'circuit of {self.service} is open')
+
+    def _success(self):
+        with self._lock:
+            if self._failures >= self.failure_threshold:
+                log.warning('circuit closed service=%s', self.service)
+            self._failures = 0
+            self._probing = False
+
+    def _answered(self):
+        # neither success nor failure, a trial call lets the next one in
+        with self._lock:
+            self._probing = False
+
+    def _failure(self) -> bool:
+        # whether the circuit is still closed
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._failures >= self.failure_threshold:
+                if self._failures == self.failure_threshold:
+                    log.warning('circuit opened service=%s', self.service)
+                self._open_until = time.time() + self.reset_timeout
+                return False
+            return True
+
+
+_upstreams = weakref.WeakSet()
+
+
+@metrics.collector
+def _collect_circuits():
+    circuits = {}
+    for upstream in list(_upstreams):
+        circuits[upstream.service] = max(circuits.get(upstream.service, 0),
+                                         int(upstream.state() != 'closed'))
+    for service, is_open in sorted(circuits.items()):
+        yield 'upstream_circuit_open', {'service': service}, is_open
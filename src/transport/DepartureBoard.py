@@ -0,0 +1,75 @@
+import threading
+from datetime import datetime
+
+import pandas as pd
+from pyhafas.profile import DBProfile
+
+
+def _values(column: pd.Series) -> list:
+    # missing values as None, categorical columns give NaN
+    return column.astype(object).where(column.notna(), None).tolist()
+
+
+class DepartureBoard:
+    """ departures of one station indexed by trip (trip_id and planned
+    time), a refresh merges the new departures into it: delay,
+    cancellation and platform are taken over, new trips are appended,
+    departed ones expire, and the resolved directions of the known trips
+    are kept so that only new trips need add_directions """
+
+    def __init__(self):
+        self.frame = None
+        self._departures = None  # frame of the last merged departures
+        # trip: (platform, direction, platform_direction)
+        self._directions = {}
+        self._lock = threading.Lock()
+
+    def merge(self, departures: pd.DataFrame) -> pd.DataFrame:
+        # departures as of Hafas.departures_to_frame, left untouched
+        with self._lock:
+            if departures is self._departures:
+                # the same cached departures, nothing changed
+                return self.frame
+        # a trip may pass the station twice (ring lines)
+        trips = departures['trip_id'] + '@' + \
+            (departures['dateTime'].astype('int64') // 10 ** 9).astype(str)
+        # local time of the server as in Hafas.get_data
+        now = pd.Timestamp(datetime.now(), tz=DBProfile.timezone)
+        frame = departures.set_axis(pd.Index(trips))
+        frame = frame[~frame.index.duplicated() &
+                      (frame['actualDepartTime'] >= now)]
+
+        with self._lock:
+            # a known trip keeps its direction unless its platform or
+            # direction changed
+            known = self._directions
+            self._directions = {
+                trip: known[trip] for trip, platform, direction in zip(
+                    frame.index, _values(frame['platform']),
+                    _values(frame['direction']))
+                if trip in known and known[trip][:2] == (platform, direction)
+            }
+            self._departures = departures
+            self.frame = frame
+        return frame
+
+    def directions(self, index: pd.Index) -> pd.Series:
+        # known directions of the trips in index, NaN for the others
+        with self._lock:
+            return pd.Series([self._directions.get(trip, (None,) * 3)[2]
+                              for trip in index], index=index, dtype=object)
+
+    def set_directions(self, df: pd.DataFrame):
+        # failed lookups and final stops ('-1') are resolved again
+        df = df[df['platform_direction'] != '-1']
+        with self._lock:
+            for trip, platform, direction, platform_direction in zip(
+                    df.index, _values(df['platform']),
+                    _values(df['direction']), df['platform_direction']):
+                if trip in self.frame.index:
+                    self._directions[trip] = (platform, direction,
+                                              platform_direction)
+
+    def __len__(self):
+        return 0 if self.frame is None else len(self.frame)
+
@@ -1,3 +1,8 @@
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import numpy as np
@@ -6,14 +11,37 @@ from dash import dash_table, html
 from pyhafas.client import HafasClient
 from pyhafas.profile import DBProfile
 
+from src.Cache import TTLCache, make_cache
 from src.LocationData import LocationData
+from src.Metrics import metrics
+from src.transport.DepartureBoard import DepartureBoard
+from src.transport.ProductProfile import ProductProfile
+from src.transport.StationIndex import StationIndex, Stop
+from src.Upstream import Upstream
 from src.utils import convert_tz
 
+log = logging.getLogger(__name__)
+
+
+def _categorical(values) -> pd.Categorical:
+    return pd.Categorical([sys.intern(value) if isinstance(value, str)
+                           else value for value in values])
+
 
 class Hafas(LocationData):
-    def __init__(self):
+    def __init__(self, departure_ttl: float = 60,
+                 departure_cache_size: int = 256,
+                 direction_ttl: float = 7 * 24 * 60 * 60,
+                 direction_cache_size: int = 20000,
+                 trip_workers: int = 8, client: HafasClient = None,
+                 upstream: Upstream = None, departure_window: int = 180,
+                 merge_boards: bool = True):
         super().__init__()
-        self.client = HafasClient(profile=DBProfile())
+        # the hafas client is created on first use, all its calls go
+        # through upstream (coalescing, retries, circuit breaker)
+        self._client = client
+        self._client_lock = threading.Lock()
+        self.upstream = upstream or Upstream('hafas')
         # products for this profile are DBProfile.availableProducts
         self.products = {
             'Bahn': ['long_distance_express', 'long_distance',
@@ -24,12 +52,56 @@ class Hafas(LocationData):
             'Tram': ['tram'],
             '...': ['ferry', 'taxi']
         }
-        self._station_direction_dict = dict()
+        # next stop per (station id, line_direction), persisted across
+        # restarts and renewed after direction_ttl for timetable changes
+        self._direction_index = make_cache(
+            'directions', ttl=direction_ttl, maxsize=direction_cache_size,
+            persistent=True)
+        self._trip_pool = ThreadPoolExecutor(max_workers=trip_workers)
+        self._inflight = {}  # trip lookups in progress per key
+        self._inflight_lock = threading.RLock()
+        self._station_index = StationIndex()  # names of all found stations
+        # departures shared by all sessions, one upstream call of all
+        # products per station and time bucket of length departure_ttl,
+        # the window of departure_window minutes covers the usual offsets
+        self.departure_window = departure_window
+        self._departure_cache = make_cache('departures', ttl=departure_ttl,
+                                           maxsize=departure_cache_size)
+        # departures merged per (station id, window), a refresh only
+        # resolves the directions of new trips (DepartureBoard),
+        # merge_boards=False rebuilds every board from scratch
+        self.merge_boards = merge_boards
+        self._boards = TTLCache(ttl=departure_window * 60,
+                                maxsize=departure_cache_size)
+        self._boards_lock = threading.Lock()
+
+    @property
+    def client(self) -> HafasClient:
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = HafasClient(profile=ProductProfile())
+        return self._client
 
     def find_locations(self, name, number):
-        new_locations = self.client.locations(name)
-        if new_locations is None:
+        if not name:
             return []
+        # searches sent to hafas before are answered locally
+        if self._station_index.knows(name, number):
+            new_locations = self._station_index.find(name, number)
+        else:
+            try:
+                new_locations = self.upstream.call(
+                    'locations', name, lambda: [
+                        Stop.from_station(station)
+                        for station in self.client.locations(name)])
+            except Exception as e:
+                log.warning('finding stations failed name=%r error=%r',
+                            name, e)
+                new_locations = None
+            if new_locations is None:
+                return []
+            self._station_index.add(new_locations, search=name)
 
         # try to find the exact match first
         # (this is not always the first element)
@@ -42,150 +114,269 @@ class Hafas(LocationData):
 
         new_locations_dict = {s.name: s for s in
                               new_locations[:min(number, len(new_locations))]}
-        self._locations.update(new_locations_dict)
+        self._add_locations(new_locations_dict)
         return list(new_locations_dict.keys())
 
+    def knows_locations(self, name, number) -> bool:
+        # whether find_locations can be answered without the hafas client
+        return bool(name) and self._station_index.knows(name, number)
+
+    @metrics.timed('section_seconds', section='transport_get_data')
     def get_data(self, name: str, products: list,
                  n_rows: int = 5, timedelta: int = 5,
                  max_duration: int = 120) -> pd.DataFrame:
-        station = self._locations[name]
+        station = self.get_location(name)
 
         # get departures from hafas client
-        products_real = {k: False for k, _ in
-                         DBProfile.availableProducts.items()}
-        for value in products:
-            for p in self.products[value]:
-                products_real[p] = True
-
-        departures = self.client.departures(
-            station=station,
-            date=datetime.now() + pd.Timedelta(timedelta, 'minutes'),
-            duration=max_duration,
-            max_trips=-1,
-            products=products_real
-        )
+        products_real = {p for value in products for p in self.products[value]}
 
-        # make pandas dataframe
-        df = []
-        for dep in departures:
-            data = [dep.station.id,
-                    dep.id,
-                    dep.cancelled,
-                    dep.dateTime,
-                    dep.delay,
-                    dep.direction,
-                    dep.name,
-                    dep.platform]
-            df.append(data)
-        df = pd.DataFrame(
-            data=df,
-            columns=['station_id', 'trip_id', 'cancelled', 'dateTime', 'delay',
-                     'direction', 'name', 'platform']
-        )
+        date = datetime.now() + pd.Timedelta(timedelta, 'minutes')
+        key = self.departure_key(station.id, date, max_duration)
+        departures = self.get_departures(station, key)
+        board = self.get_board(key[:2])
+        df = board.merge(departures)
 
-        # filter cancelled trips
-        df = df[~(df['cancelled'])].copy()
+        # the cached departures are shared by all offsets and products,
+        # cut out the ones of this board (legs without product are kept)
+        start = pd.Timestamp(date, tz=DBProfile.timezone)
+        end = start + pd.Timedelta(max_duration, 'minutes')
+        df = df[~df['cancelled'] & (df['actualDepartTime'] >= start) &
+                (df['dateTime'] < end) &
+                (df['product'].isin(products_real) |
+                 df['product'].isna())].copy()
 
-        # add directions by checking the next stop
-        df = self.add_directions(df)
+        # add directions by checking the next stop, for the trips whose
+        # direction is not known from an earlier refresh
+        df['platform_direction'] = board.directions(df.index)
+        missing = df['platform_direction'].isna()
+        if missing.any():
+            resolved = self.add_directions(df[missing].copy())
+            df.loc[missing, 'platform_direction'] = \
+                resolved['platform_direction']
+            board.set_directions(resolved)
 
-        # stuff related to times
+        # local times and the first trips of each direction
         df = convert_tz(df)
-        df['dateTime'] = pd.to_datetime(df['dateTime'])
-        df['delay'] = pd.to_timedelta(df['delay'])
-        df['delay'] = df['delay'].fillna(pd.Timedelta(0))
-        df['actualDepartTime'] = df['dateTime'] + df['delay']
-
-        def foo(g, n_trips):
-            f = g.sort_values(by='actualDepartTime', ascending=True)
-            f = f if len(f) <= n_trips else f.iloc[:n_trips, :]
-            return f
-
-        # sort
-        # df = df.sort_values(by='actualDepartTime', ascending=True)
-        n_trips = int(np.ceil(n_rows / df['platform_direction'].nunique()))
-        df = df.groupby('platform_direction').apply(foo, n_trips)
-        df = df.reset_index(drop=True)
+        df = self.trim_departures(df, n_rows)
 
         return df
 
+    @staticmethod
+    def departures_to_frame(departures: list) -> pd.DataFrame:
+        # build the columns straight from the departure objects,
+        # times go through epoch seconds which is much faster than
+        # parsing a list of tz-aware datetime objects, the strings
+        # repeating across rows and refreshes are interned categoricals,
+        # the columns keep their types for boards without departures
+        date_time = pd.to_datetime(
+            np.array([dep.dateTime.timestamp() for dep in departures],
+                     dtype=float), unit='s', utc=True)
+        delay = pd.to_timedelta(
+            np.array([dep.delay.total_seconds() if dep.delay else 0.0
+                      for dep in departures], dtype=float), unit='s')
+        return pd.DataFrame({
+            'station_id': _categorical(dep.station.id for dep in departures),
+            'trip_id': np.array([dep.id for dep in departures],
+                                dtype=object),
+            'cancelled': np.array([bool(dep.cancelled) for dep in departures],
+                                  dtype=bool),
+            'dateTime': date_time,
+            'delay': delay,
+            'actualDepartTime': date_time + delay,
+            'direction': _categorical(dep.direction for dep in departures),
+            'name': _categorical(dep.name for dep in departures),
+            'platform': _categorical(dep.platform for dep in departures),
+            'product': _categorical(getattr(dep, 'product', None)
+                                    for dep in departures),
+        })
+
+    @staticmethod
+    def trim_departures(df: pd.DataFrame, n_rows: int) -> pd.DataFrame:
+        # keep the next n_trips of each direction, grouped by direction
+        if df.empty:
+            return df.reset_index(drop=True)
+        n_trips = int(np.ceil(n_rows / df['platform_direction'].nunique()))
+        df = df.sort_values(by=['platform_direction', 'actualDepartTime'],
+                            kind='stable')
+        df = df.groupby('platform_direction', sort=False).head(n_trips)
+        return df.reset_index(drop=True)
+
+    def departure_key(self, station_id: str, date: datetime,
+                      duration: int) -> tuple:
+        # departures of all products from the start of the current time
+        # bucket, every offset whose board ends within the window shares
+        # the same query, larger offsets get a window of their own
+        ttl = self._departure_cache.ttl
+        bucket = int(time.time() // ttl)
+        window = self.departure_window
+        if date.timestamp() + duration * 60 > bucket * ttl + window * 60:
+            bucket = int(date.timestamp() // ttl)
+            window = duration
+        return station_id, window, bucket
+
+    def get_departures(self, station: Stop, key: tuple) -> pd.DataFrame:
+        _, window, bucket = key
+        ttl = self._departure_cache.ttl
+        departures = self._departure_cache.get(key)
+        if departures is None:
+            # the departures of an earlier bucket stand in if hafas fails,
+            # get_data drops the ones that are gone already, only the
+            # frame of the departures is kept
+            departures = self.upstream.call(
+                'departures', key, lambda: self.departures_to_frame(
+                    self.client.departures(
+                        station=station.id,
+                        date=datetime.fromtimestamp(bucket * ttl),
+                        duration=window,
+                        max_trips=-1,
+                        products={p: True for p in
+                                  DBProfile.availableProducts})),
+                stale_key=key[:2])
+            self._departure_cache.set(key, departures)
+        return departures
+
+    def get_board(self, key: tuple) -> DepartureBoard:
+        if not self.merge_boards:
+            return DepartureBoard()
+        with self._boards_lock:
+            board = self._boards.get(key)
+            if board is None:
+                board = DepartureBoard()
+                self._boards.set(key, board)
+        return board
+
+    def cache_stats(self) -> dict:
+        return {'departures': self._departure_cache.stats(),
+                'directions': self._direction_index.stats(),
+                'boards': self._boards.stats()}
+
     def add_directions(self, df: pd.DataFrame) -> pd.DataFrame:
-        # find and sort by direction, get trip details only once
-        next_stop_id_list = []
-        cols = ['trip_id', 'name', 'direction', 'station_id', 'platform']
-        for idx, row in df[cols].iterrows():
-            station_id = row['station_id']
-            trip_id = row['trip_id']
-            platform = row['platform']
-
-            if platform:
-                next_stop_id_list.append(str(platform))
-            else:
-                # store information for later
-                if station_id not in self._station_direction_dict:
-                    self._station_direction_dict.update({station_id: dict()})
-
-                name_direction = f"{row['name']}_{row['direction']}"
-                if name_direction in self._station_direction_dict[station_id]:
-                    next_stop_id = self._station_direction_dict[station_id][
-                        name_direction]
-                else:
-                    # get each trips info
-                    trip_info = self.client.trip(trip_id)
-                    # find current stop in list and get next stop
-                    stopovers = trip_info.stopovers
-                    stop_idx = [idx for idx in range(len(stopovers)) if
-                                stopovers[idx].stop.id == station_id]
-                    if len(stop_idx) == 1:
-                        stop_idx = stop_idx[0]
-                        if len(stopovers) > stop_idx:
-                            next_stop_id = stopovers[stop_idx + 1].stop.id
-                        else:
-                            # Endhaltestelle or other error in finding
-                            # this station in the trip
-                            next_stop_id = '-1'
-                    else:
-                        # not found or disambigius
-                        next_stop_id = '-1'
-                    self._station_direction_dict[station_id].update(
-                        {name_direction: next_stop_id})
-
-                next_stop_id_list.append(str(next_stop_id))
-
-        df['platform_direction'] = next_stop_id_list
+        # find and sort by direction, the platform if there is one,
+        # otherwise the next stop of the trip, the time spent waiting
+        # for trip lookups is measured apart from the local work
+        with metrics.timer('section_seconds',
+                           section='transport_add_directions') as total:
+            df, upstream = self._add_directions(df)
+        metrics.observe('section_seconds', total.elapsed - upstream,
+                        section='transport_add_directions_local')
         return df
 
-    def data_to_table(self, df: pd.DataFrame, name: str,
-                      light_mode=True) -> dash_table.DataTable:
-        # format departure times with delays
-        df['delay'] = round(df['delay'].dt.total_seconds() / 60).astype(int)
-        time_string = df['dateTime'].dt.strftime('%H:%M')
-        delay_string = df['delay'].apply(
-            lambda u: '({:+d})'.format(u))  # :+d adds sign of u to string of u
-        delay_string[df['delay'] == 0] = ''  # leave empty if there is no delay
-        df['Abfahrt'] = time_string + ' ' + delay_string
-        df['Bahnsteig'] = df['platform'].str.strip().values
-        df['Linie'] = df['name'].str.strip().values
-        df['Richtung'] = df['direction'].str.strip().values
-
-        # stripes for different directions
-        stripes = 'platform_direction'
-        if stripes is not None and df[stripes].nunique() > 1:
-            stripes_rows = [i for i in list(df.index) if
-                            df.loc[i, stripes] in df[stripes].unique()[::2]]
+    def _add_directions(self, df: pd.DataFrame) -> tuple:
+        has_platform = df['platform'].notna() & (df['platform'] != '')
+        name_direction = df['name'].astype(str) + '_' + \
+            df['direction'].astype(str)
+
+        # collect the unknown (station, line_direction) keys first,
+        # so that each of them costs at most one trip lookup
+        directions = {}
+        unresolved = {}
+        for key, trip_id in zip(
+                zip(df.loc[~has_platform, 'station_id'],
+                    name_direction[~has_platform]),
+                df.loc[~has_platform, 'trip_id']):
+            if key in directions or key in unresolved:
+                continue
+            next_stop_id = self._direction_index.get(key)
+            if next_stop_id is None:
+                unresolved[key] = trip_id
+            else:
+                directions[key] = next_stop_id
+        with metrics.timer('section_seconds',
+                           section='transport_resolve_directions') as lookups:
+            directions.update(self._resolve_directions(unresolved))
+
+        # map back onto the frame
+        next_stop = pd.Series(
+            list(directions.values()),
+            index=pd.MultiIndex.from_tuples(list(directions.keys())),
+            dtype=object) if directions else pd.Series(dtype=object)
+        next_stop = next_stop.reindex(
+            pd.MultiIndex.from_arrays([df['station_id'], name_direction]))
+        df['platform_direction'] = np.where(
+            has_platform, df['platform'].astype(str),
+            next_stop.astype(str).values)
+        return df, lookups.elapsed
+
+    def _resolve_directions(self, unresolved: dict) -> dict:
+        # look up the trips concurrently, a key that is already being
+        # looked up by another request is not requested again
+        futures = {}
+        with self._inflight_lock:
+            for key, trip_id in unresolved.items():
+                future = self._inflight.get(key)
+                if future is None:
+                    future = self._trip_pool.submit(self._next_stop, trip_id,
+                                                    key[0])
+                    # registered before the callback, a lookup that is
+                    # done already removes itself right away
+                    self._inflight[key] = future
+                    future.add_done_callback(
+                        lambda f, key=key: self._store_direction(key, f))
+                futures[key] = future
+
+        # failed lookups are tried again at the next refresh
+        directions = {}
+        for key, future in futures.items():
+            if future.exception() is None:
+                directions[key] = future.result()
+            else:
+                directions[key] = '-1'
+        return directions
+
+    def _store_direction(self, key: tuple, future):
+        with self._inflight_lock:
+            self._inflight.pop(key, None)
+        if future.exception() is None:
+            self._direction_index.set(key, future.result())
+
+    def _next_stop(self, trip_id: str, station_id: str) -> str:
+        # get the trip info
+        trip_info = self.upstream.call('trip', trip_id,
+                                       lambda: self.client.trip(trip_id))
+        # find current stop in list and get next stop
+        stopovers = trip_info.stopovers
+        stop_idx = [idx for idx in range(len(stopovers)) if
+                    stopovers[idx].stop.id == station_id]
+        if len(stop_idx) == 1 and stop_idx[0] + 1 < len(stopovers):
+            return stopovers[stop_idx[0] + 1].stop.id
         else:
-            stripes_rows = []
+            # Endhaltestelle, not found or disambigius
+            return '-1'
+
+    # columns shown in the departure tables
+    table_columns = ['Abfahrt', 'Linie', 'Richtung']
+
+    @staticmethod
+    @metrics.timed('section_seconds', section='transport_data_to_records')
+    def data_to_records(df: pd.DataFrame) -> list:
+        # format departure times with delays, df is left untouched
+        delay = (df['delay'].dt.total_seconds() / 60).round().astype(int)
+        sign = pd.Series(np.where(delay > 0, '+', ''), index=df.index)
+        delay_string = ('(' + sign + delay.astype(str) + ')').where(
+            delay != 0, '')  # leave empty if there is no delay
+
+        # stripes for every other direction
+        codes, uniques = pd.factorize(df['platform_direction'])
+        stripe = (codes % 2 == 0) & (len(uniques) > 1)
 
-        # create table
-        df = df.reset_index(drop=True)
-        show_columns = ['Abfahrt', 'Linie', 'Richtung']
+        # only the shown columns are sent to the browser
+        return pd.DataFrame({
+            'Abfahrt': df['dateTime'].dt.strftime('%H:%M') + ' ' +
+            delay_string,
+            'Linie': df['name'].str.strip(),
+            'Richtung': df['direction'].str.strip(),
+            'stripe': stripe.astype(int)
+        }).to_dict('records')
 
-        stripes_color = \
-            'rgb(220, 220, 220)' if light_mode else 'rgb(70, 70, 70)'
+    def make_table(self, name: str, records: list = None,
+                   message: str = None) -> html.Div:
+        # the table is created once per station, refreshes only replace
+        # its data and the title, the stripes color follows the theme
+        # through a css variable (assets/dashboard.css)
         table = dash_table.DataTable(
-            data=df.to_dict('records'),
-            id=name,
-            columns=[{"name": c, "id": c} for c in show_columns],
+            data=records or [],
+            id={'type': 'transport_table', 'index': name},
+            columns=[{"name": c, "id": c} for c in self.table_columns],
             style_data={
                 'whiteSpace': 'nowrap',
                 'height': 'auto'
@@ -218,15 +409,24 @@ class Hafas(LocationData):
                     'color': 'green',
                 },
                 {
-                    'if': {'row_index': stripes_rows},
-                    'backgroundColor': stripes_color
+                    'if': {'filter_query': '{stripe} = 1'},
+                    'backgroundColor': 'var(--stripes-color)'
                 }
             ]
         )
 
-        name_short = name.split(',')[0]  # only the first part of the name
         table = html.Div([
-            html.Div(name_short),
+            html.Div(self.table_title(name, message),
+                     id={'type': 'transport_title', 'index': name}),
             table
         ])
         return table
+
+    @staticmethod
+    def table_title(name: str, message: str = None) -> list:
+        name_short = name.split(',')[0]  # only the first part of the name
+        if message:
+            return [name_short, ' ',
+                    html.Small(f'({message})', className='text-danger')]
+        return [name_short]
+
@@ -0,0 +1,25 @@
+from pyhafas.profile import DBProfile
+
+
+class ProductProfile(DBProfile):
+    """ DB profile whose station board legs know their product
+    (leg.product, e.g. 'suburban'), so that one query of all products
+    can be filtered locally """
+
+    def parse_station_board_request(self, data, departure_arrival_prefix):
+        legs = super().parse_station_board_request(data,
+                                                   departure_arrival_prefix)
+        # the legs are parsed one by one from jnyL
+        products = data.common.get('prodL', [])
+        for leg, raw_leg in zip(legs, data.res.get('jnyL') or []):
+            product = products[raw_leg['prodX']] \
+                if raw_leg.get('prodX') is not None else {}
+            leg.product = self.product_name(product.get('cls'))
+        return legs
+
+    @classmethod
+    def product_name(cls, bitmask):
+        for name, bitmasks in cls.availableProducts.items():
+            if bitmask in bitmasks:
+                return name
+        return None
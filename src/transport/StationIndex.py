@@ -0,0 +1,84 @@
+import threading
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True, slots=True)
+class Stop:
+    # what is kept of a pyhafas Station for the selected stations
+    id: str
+    name: str
+
+    @classmethod
+    def from_station(cls, station) -> 'Stop':
+        return cls(id=station.id, name=station.name)
+
+
+class StationIndex:
+    """ sorted prefix index over the names of all stations found so far,
+    every word of a name is a starting point, e.g. 'Alex' finds
+    'Berlin Alexanderplatz'; a search is answered from it only if HAFAS
+    was asked for the same or a shorter prefix before, in its order """
+
+    def __init__(self):
+        self._keys = []  # sorted (normalised name suffix, name)
+        self._stations = {}  # name: Stop
+        self._searches = {}  # normalised search: {name: rank by HAFAS}
+        self._lock = threading.Lock()
+
+    def add(self, stations: list, search: str = None):
+        # stations found by HAFAS for search, in its order
+        with self._lock:
+            if search is not None:
+                self._searches[self.normalise(search)] = {
+                    station.name: rank for rank, station in
+                    enumerate(stations, -len(stations))}
+            for station in stations:
+                if station.name in self._stations:
+                    continue
+                self._stations[station.name] = station
+                words = self.normalise(station.name).split(' ')
+                for i in range(len(words)):
+                    insort(self._keys, (' '.join(words[i:]), station.name))
+
+    def knows(self, prefix: str, number: int) -> bool:
+        # whether find answers prefix as HAFAS would
+        with self._lock:
+            return number == 1 and prefix in self._stations or \
+                self._search(self.normalise(prefix)) is not None
+
+    def find(self, prefix: str, number: int) -> list:
+        # stations with a word starting with prefix, the exact match
+        # first and the others in the order HAFAS gave them
+        exact = self._stations.get(prefix)
+        if exact is not None and number == 1:
+            return [exact]
+        prefix = self.normalise(prefix)
+        with self._lock:
+            ranks = self._search(prefix) or {}
+            names = {}
+            idx = bisect_left(self._keys, (prefix,))
+            while idx < len(self._keys) and \
+                    self._keys[idx][0].startswith(prefix):
+                names.setdefault(self._keys[idx][1], None)
+                idx += 1
+            stations = [self._stations[name] for name in names]
+        # the ranks are negative, names HAFAS did not give (0) follow in
+        # the order of the index
+        stations.sort(key=lambda s: (s is not exact, ranks.get(s.name, 0)))
+        return stations[:number]
+
+    def _search(self, prefix: str):
+        # ranks of the longest search prefix starts with, None if none
+        for end in range(len(prefix), 0, -1):
+            ranks = self._searches.get(prefix[:end])
+            if ranks is not None:
+                return ranks
+        return None
+
+    def __len__(self):
+        return len(self._stations)
+
+    @staticmethod
+    def normalise(name: str) -> str:
+        return ' '.join(name.casefold().split())
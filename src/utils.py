@@ -1,5 +1,8 @@
 import os
+import threading
+import time
 
+import numpy as np
 import pandas as pd
 import pytz
 
@@ -18,3 +21,64 @@ def convert_tz(df: pd.DataFrame, default_tz='Europe/Berlin') -> pd.DataFrame:
         df[col] = df[col].dt.tz_convert(tz).dt.tz_localize(None)
 
     return df
+
+
+def write_parquet(df: pd.DataFrame, path: str):
+    """ write df to path through a temporary file, readers in other
+    processes never see a half-written file """
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        df.to_parquet(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_points: int) -> np.ndarray:
+    """ indices of the points kept by largest-triangle-three-buckets
+    downsampling of the line (x, y) to n_points points """
+    n = len(x)
+    if n_points >= n or n_points < 3:
+        return np.arange(n)
+    # plain floats, the buckets are too small for numpy to pay off
+    x = (x.astype('datetime64[s]').astype(float)
+         if np.issubdtype(x.dtype, np.datetime64) else x.astype(float))
+    x, y = x.tolist(), np.nan_to_num(y.astype(float)).tolist()
+    # the first and the last point are kept, the others are split into
+    # n_points - 2 buckets with one point each, the one spanning the
+    # largest triangle with the previous point and the next bucket
+    edges = np.linspace(1, n - 1, n_points - 1).astype(int).tolist()
+    edges.append(n)
+    kept = [0]
+    for i in range(n_points - 2):
+        start, end, following = edges[i], edges[i + 1], edges[i + 2]
+        next_x = sum(x[end:following]) / (following - end)
+        next_y = sum(y[end:following]) / (following - end)
+        x0, y0 = x[kept[-1]], y[kept[-1]]
+        areas = [abs((x0 - next_x) * (y[j] - y0) -
+                     (x0 - x[j]) * (next_y - y0)) for j in range(start, end)]
+        kept.append(start + areas.index(max(areas)))
+    kept.append(n - 1)
+    return np.array(kept)
+
+
+class Debouncer:
+    """ lets only the newest of several calls with the same key through,
+    calling it blocks for delay seconds """
+
+    def __init__(self, delay: float = 0.3):
+        self.delay = delay
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, key) -> bool:
+        token = object()
+        with self._lock:
+            self._latest[key] = token
+        time.sleep(self.delay)
+        with self._lock:
+            if self._latest.get(key) is token:
+                self._latest.pop(key)
+                return True
+            return False
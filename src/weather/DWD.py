@@ -1,18 +1,40 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
 from datetime import date, timedelta
 
+import numpy as np
 import pandas as pd
-import plotly.express as px
-from dash import dcc
-from geopy.geocoders import HereV7, Nominatim
-from wetterdienst.provider.dwd.mosmix import DwdMosmixRequest, DwdMosmixType
-from wetterdienst.settings import Settings
+import plotly.io as pio
 
+from src.Cache import CACHE_DIR, TTLCache, make_cache
 from src.LocationData import LocationData
-from src.utils import convert_tz
+from src.Metrics import metrics
+from src.Upstream import Upstream
+from src.utils import convert_tz, lttb, write_parquet
+from src.weather.Mosmix import Mosmix
+
+log = logging.getLogger(__name__)
+
+EARTH_RADIUS = 6371.0  # km
+# conversion of the MOSMIX units by parameter prefix: (factor, offset)
+UNITS = {
+    'temperature': (1.0, -273.15),  # Kelvin to Celsius
+    'wind_speed': (3.6, 0.0),  # m/s to km/h
+    'sunshine_duration': (1 / 3600, 0.0)  # seconds to hours
+}
 
 
 class DWD(LocationData):
-    def __init__(self, api_keys):
+    def __init__(self, api_keys, station_refresh: float = 24 * 60 * 60,
+                 max_distance: float = 50, issue_check: float = 5 * 60,
+                 geocode_ttl: float = 30 * 24 * 60 * 60,
+                 geocode_cache_size: int = 10000, client: Mosmix = None,
+                 geocoder=None, upstream: Upstream = None,
+                 geocoder_upstream: Upstream = None, display_days: int = 4,
+                 max_points: int = 1000):
         super().__init__()
         # I don't know whether this needs to be initialized at
         # every request or it's enough to do this once here
@@ -22,33 +44,105 @@ class DWD(LocationData):
             'precipitation_height_significant_weather_last_1h',
             'humidity'
         ]
-        self.DwdSettings = Settings(ts_humanize=True, ts_si_units=True,
-                                    ts_skip_empty=True)
+        # geopy, scipy and the plotly figures are slow to import, they are
+        # only loaded when they are needed, so is wetterdienst by Mosmix
+        self.client = client or Mosmix(self.DwdParameter)
+        # calls of the DWD server and the geocoder go through upstream
+        # (coalescing, retries, circuit breaker, last good results)
+        self.upstream = upstream or Upstream('dwd')
+        self.geocoder_upstream = geocoder_upstream or Upstream('geocoder')
+
+        # catalogue of the MOSMIX stations, cached on disk and indexed
+        # for nearest station lookups, renewed after station_refresh
+        self.station_refresh = station_refresh
+        self.max_distance = max_distance  # km
+        self._stations_file = os.path.join(CACHE_DIR,
+                                           'mosmix_stations.parquet')
+        self._stations = None
+        self._stations_tree = None
+        self._stations_loaded = 0.0
+        self._stations_lock = threading.Lock()
+        self._nearest_station = TTLCache(ttl=station_refresh, maxsize=1024)
+
+        # parsed forecasts per (station id, issue time) shared by all
+        # sessions, the server is asked for a new issue every issue_check,
+        # they are stored as shown: converted units, one column per
+        # parameter and only the display_days of the figure
+        self.display_days = display_days
+        # the lines of a chart are downsampled to max_points points
+        # in total, None shows every hourly value
+        self.max_points = max_points
+        self._issue_time = TTLCache(ttl=issue_check, maxsize=1)
+        self._forecasts = make_cache('forecasts', ttl=24 * 60 * 60,
+                                     maxsize=512)
+        self._forecasts_dir = os.path.join(CACHE_DIR, 'forecasts')
+        self._downloads = {}  # (station id, issue): Future of the download
+        self._forecasts_lock = threading.Lock()
 
-        # geocoding engine
+        # geocoding engine, created on first use
+        self._api_keys = api_keys
+        self._geo = geocoder
+        self._geo_lock = threading.Lock()
+        self._geocode_cache = make_cache('geocode', ttl=geocode_ttl,
+                                         maxsize=geocode_cache_size,
+                                         persistent=True)
+
+    @property
+    def geo(self):
+        if self._geo is None:
+            with self._geo_lock:
+                if self._geo is None:
+                    self._geo = self._make_geocoder(self._api_keys)
+        return self._geo
+
+    @staticmethod
+    def _make_geocoder(api_keys):
+        from geopy.geocoders import HereV7, Nominatim
         if api_keys.here != '':
-            self.geo = HereV7(apikey=api_keys.here)
-        else:
-            print("falling back to Nominatim API for "
-                  "geocoding (this might fail due to rate limit)")
-            self.geo = Nominatim(
-                user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:66.0)'
-                           ' Gecko/20100101 Firefox/66.0')
+            return HereV7(apikey=api_keys.here)
+        log.warning('falling back to Nominatim API for geocoding '
+                    '(this might fail due to rate limit)')
+        return Nominatim(
+            user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:66.0)'
+                       ' Gecko/20100101 Firefox/66.0')
 
     def find_locations(self, name, number):
         if name:
             # get lon, lat of location
-            new_locations = self.geo.geocode(name, exactly_one=False,
-                                             limit=number)
-            if new_locations is None:
+            try:
+                new_locations = self._geocode(name, number)
+            except Exception as e:
+                log.warning('geocoding failed name=%r error=%r', name, e)
                 return []
-            new_locations_dict = {s[0]: s[1] for s in
-                                  new_locations}  # name: (lat, lon)
-            self._locations.update(new_locations_dict)
+            new_locations_dict = dict(new_locations)  # name: (lat, lon)
+            self._add_locations(new_locations_dict)
             return list(new_locations_dict.keys())
         else:
             return []
 
+    def _geocode(self, name: str, number: int) -> list:
+        # geocoding results are shared by all sessions and kept on disk
+        key = (self._normalise(name), number)
+        locations = self._geocode_cache.get(key)
+        if locations is None:
+            new_locations = self.geocoder_upstream.call(
+                'geocode', key, lambda: self.geo.geocode(
+                    name, exactly_one=False, limit=number))
+            locations = [(s[0], tuple(s[1])) for s in new_locations or []]
+            # keep unsuccessful searches only for a short while
+            self._geocode_cache.set(
+                key, locations, ttl=None if locations else 24 * 60 * 60)
+            # selecting one of the results looks it up by its address
+            for address, latlon in locations:
+                self._geocode_cache.set((self._normalise(address), 1),
+                                        [(address, latlon)])
+        return locations
+
+    @staticmethod
+    def _normalise(name: str) -> str:
+        return ' '.join(name.casefold().split())
+
+    @metrics.timed('section_seconds', section='weather_get_data')
     def get_data(self, name: str) -> pd.DataFrame:
 
         # parameter in ['cloud_cover_above_7_km', 'cloud_cover_below_1000_ft',
@@ -77,70 +171,275 @@ class DWD(LocationData):
         #  'weather_significant', 'wind_direction', 'wind_gust_max_last_12h',
         #  'wind_gust_max_last_1h', 'wind_gust_max_last_3h', 'wind_speed']
 
-        # forecast service
-        dwd_request = DwdMosmixRequest(
-            # parameter='small',
-            parameter=self.DwdParameter,
-            mosmix_type=DwdMosmixType.SMALL,
-            # large is only released very 6 hours (3, 9, 15, 21)
-            settings=self.DwdSettings,
-        )
-
         # get the weather stations near lon, lat of the locations
         nearest_stations = {}
         for n in name:
-            latlon = self._locations[n]
-            nearby_stations = dwd_request.filter_by_distance(
-                latlon,
-                distance=50,
-                unit='km').df.to_pandas()
-            # already sorted: nearby_stations =
-            # nearby_stations.sort_values(by='distance', axis=0)
-            nearest_stations[nearby_stations.loc[0, 'station_id']] = \
-                nearby_stations.loc[0, 'name']
+            station = self.nearest_station(self.get_location(n))
+            if station is None:
+                log.warning('no weather station location=%r '
+                            'max_distance_km=%s', n, self.max_distance)
+                continue
+            nearest_stations[station[0]] = station[1]
 
         # get the weather data of those stations
-        forecast = dwd_request.filter_by_station_id(
-            list(nearest_stations.keys())).values.all().df.to_pandas()
-        forecast['name'] = forecast['station_id'].apply(
-            lambda u: nearest_stations[u])
-        forecast = convert_tz(forecast)
+        forecast = self.get_forecast(list(nearest_stations.keys()))
+        forecast['name'] = forecast['station_id'].map(nearest_stations)
         return forecast
 
-    @staticmethod
-    def data_to_graph(df: pd.DataFrame, name: str,
-                      light_mode=True) -> dcc.Graph:
+    def issue_time(self) -> str:
+        # issue time of the latest MOSMIX-S forecast as YYYYmmddHHMM
+        # (the last known issue stands in if the server fails)
+        issue = self._issue_time.get('latest')
+        if issue is None:
+            issue = self.upstream.call('issue_time', None,
+                                       self.client.issue_time)
+            self._issue_time.set('latest', issue)
+        return issue
+
+    def get_forecast(self, station_ids: list) -> pd.DataFrame:
+        # forecasts are only downloaded once per station and issue
+        issue = self.issue_time()
+        forecasts = {sid: self._cached_forecast(sid, issue)
+                     for sid in station_ids}
+        missing = [sid for sid, df in forecasts.items() if df is None]
+        if missing:
+            forecasts.update(self._download_missing(missing, issue))
+
+        forecasts = [df for df in forecasts.values() if df is not None]
+        if len(forecasts) == 0:
+            return pd.DataFrame(columns=['station_id', 'date'] +
+                                self.DwdParameter)
+        return pd.concat(forecasts, ignore_index=True)
 
-        df = df.rename({'date': 'Datum', 'name': 'Wetterstation'}, axis=1)
-        # adjust temperature from Kelvin to Celsius
-        mask_kelvin = df['parameter'].str.startswith('temperature')
-        df.loc[mask_kelvin, 'value'] -= 273.15
+    def _cached_forecast(self, station_id: str, issue: str):
+        key = (station_id, issue, self.display_days)
+        df = self._forecasts.get(key)
+        if df is None:
+            try:
+                df = pd.read_parquet(self._forecast_file(station_id, issue))
+            except FileNotFoundError:
+                # not downloaded yet or removed by a newer issue
+                return None
+            self._forecasts.set(key, df)
+        return df
 
-        # adjust wind speed from m/s to km/h
-        mask_wind = df['parameter'].str.startswith('wind_speed')
-        df.loc[mask_wind, 'value'] *= 3.6
+    def _download_missing(self, station_ids: list, issue: str) -> dict:
+        # the missing forecasts of all selected locations are downloaded
+        # in one call, stations another thread is downloading already
+        # are waited for, the lock is not held while downloading
+        candidates = set(station_ids) | {
+            sid for sid in self._selected_stations()
+            if self._cached_forecast(sid, issue) is None}
+        waiting, own = {}, {}
+        with self._forecasts_lock:
+            for sid in candidates:
+                future = self._downloads.get((sid, issue))
+                if future is None:
+                    # another thread might have downloaded it meanwhile
+                    df = self._cached_forecast(sid, issue)
+                    if df is not None:
+                        future = Future()
+                        future.set_result(df)
+                    else:
+                        future = self._downloads[(sid, issue)] = Future()
+                        own[sid] = future
+                if sid in station_ids:
+                    waiting[sid] = future
 
-        # adjust sunshine duration from seconds to hours
-        mask_sun = df['parameter'].str.startswith('sunshine_duration')
-        df.loc[mask_sun, 'value'] /= 3600.0
+        if own:
+            try:
+                forecasts = self._download_forecast(list(own), issue)
+                for sid, future in own.items():
+                    future.set_result(forecasts.get(sid))
+            except BaseException as e:
+                for future in own.values():
+                    if not future.done():
+                        future.set_exception(e)
+                raise
+            finally:
+                with self._forecasts_lock:
+                    for sid in own:
+                        self._downloads.pop((sid, issue), None)
+        return {sid: future.result() for sid, future in waiting.items()}
 
-        # create figure https://plotly.com/python/facet-plots/
-        figure = px.line(df, x='Datum', y='value', color='Wetterstation',
-                         facet_row='parameter', facet_row_spacing=0.05)
-        figure.add_hline(y=0, line_dash="solid")
+    def _selected_stations(self) -> set:
+        # nearest stations of the locations selected by any session
+        with self._lock:
+            locations = list(self._locations.values())
+        stations = set()
+        for latlon in locations:
+            station = self.nearest_station(latlon)
+            if station is not None:
+                stations.add(station[0])
+        return stations
+
+    def _download_forecast(self, station_ids: list, issue: str) -> dict:
+        forecast = self.upstream.call(
+            'forecast', (issue, tuple(sorted(station_ids))),
+            lambda: self.client.forecast(station_ids))
+        forecast = self._normalise_forecast(forecast)
+
+        # drop the files of older issues, another worker sharing the
+        # directory might have done so already
+        os.makedirs(self._forecasts_dir, exist_ok=True)
+        for file_name in os.listdir(self._forecasts_dir):
+            if not file_name.startswith(issue):
+                try:
+                    os.remove(os.path.join(self._forecasts_dir, file_name))
+                except FileNotFoundError:
+                    pass
+
+        forecasts = {}
+        for station_id, df in forecast.groupby('station_id', observed=True):
+            df = df.reset_index(drop=True)
+            df['station_id'] = df['station_id'].cat.remove_unused_categories()
+            write_parquet(df, self._forecast_file(station_id, issue))
+            self._forecasts.set((station_id, issue, self.display_days), df)
+            forecasts[station_id] = df
+        return forecasts
+
+    def _normalise_forecast(self, forecast: pd.DataFrame) -> pd.DataFrame:
+        # the long MOSMIX frame as shown: station_id, local date and one
+        # float32 column per parameter in display units, up to the end
+        # of the display window
+        forecast = forecast.pivot_table(
+            index=['station_id', 'date'], columns='parameter',
+            values='value', aggfunc='first', observed=True)
+        forecast = forecast.reindex(columns=self.DwdParameter)
+        for parameter in forecast.columns:
+            for prefix, (factor, offset) in UNITS.items():
+                if parameter.startswith(prefix):
+                    forecast[parameter] = forecast[parameter] * factor + offset
+        forecast = convert_tz(forecast.astype('float32').reset_index())
+        forecast.columns.name = None
+        end = pd.Timestamp(date.today() + timedelta(days=self.display_days))
+        forecast = forecast[forecast['date'] <= end]
+        return forecast.astype({'station_id': 'category'})
+
+    def cache_stats(self) -> dict:
+        return {'forecasts': self._forecasts.stats(),
+                'geocode': self._geocode_cache.stats(),
+                'nearest_station': self._nearest_station.stats()}
+
+    def _forecast_file(self, station_id: str, issue: str) -> str:
+        return os.path.join(
+            self._forecasts_dir,
+            f'{issue}_{station_id}_{self.display_days}d.parquet')
+
+    @metrics.timed('section_seconds', section='weather_nearest_station')
+    def nearest_station(self, latlon: tuple):
+        # (station_id, name) of the closest station within max_distance
+        key = (round(latlon[0], 5), round(latlon[1], 5))
+        station = self._nearest_station.get(key)
+        if station is None:
+            stations, tree = self._station_index()
+            distance, idx = tree.query(self._to_xyz(*key))
+            distance = 2 * EARTH_RADIUS * np.arcsin(min(distance / 2, 1.0))
+            if distance > self.max_distance:
+                station = ()
+            else:
+                station = (stations['station_id'].iloc[idx],
+                           stations['name'].iloc[idx])
+            self._nearest_station.set(key, station)
+        return station if station else None
+
+    def _station_index(self) -> tuple:
+        # load the station catalogue once and build the spatial index
+        from scipy.spatial import cKDTree
+        with self._stations_lock:
+            if self._stations_tree is None or \
+                    self._stations_loaded < time.time() - self.station_refresh:
+                self._stations = self._load_stations()
+                self._stations_tree = cKDTree(self._to_xyz(
+                    self._stations['latitude'].values,
+                    self._stations['longitude'].values))
+                self._stations_loaded = time.time()
+            return self._stations, self._stations_tree
+
+    def _load_stations(self) -> pd.DataFrame:
+        # the file on disk is used as long as it is recent enough or
+        # as a fallback if the DWD server is not reachable
+        path = self._stations_file
+        if os.path.exists(path) and \
+                os.path.getmtime(path) >= time.time() - self.station_refresh:
+            return pd.read_parquet(path)
+        try:
+            stations = self.upstream.call('stations', None,
+                                          self.client.stations)
+        except Exception:
+            if os.path.exists(path):
+                return pd.read_parquet(path)
+            raise
+        stations = stations[['station_id', 'name', 'latitude', 'longitude']]
+        stations = stations.reset_index(drop=True)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        write_parquet(stations, path)
+        return stations
+
+    @staticmethod
+    def _to_xyz(lat, lon) -> np.ndarray:
+        # points on the unit sphere, the euclidean nearest neighbour
+        # is also the nearest one on the globe
+        lat, lon = np.radians(lat), np.radians(lon)
+        return np.stack([np.cos(lat) * np.cos(lon),
+                         np.cos(lat) * np.sin(lon),
+                         np.sin(lat)], axis=-1)
+
+    @metrics.timed('section_seconds', section='weather_data_to_figure')
+    def data_to_figure(self, df: pd.DataFrame) -> dict:
+        # the figure without theme as plain dict, it can be cached and
+        # themed later on without building it again, one chart per
+        # parameter and one line per weather station
+        from plotly.colors import qualitative
+        from plotly.subplots import make_subplots
+        parameters = [p for p in self.DwdParameter if p in df.columns]
+        figure = make_subplots(
+            rows=len(parameters), cols=1, shared_xaxes=True,
+            vertical_spacing=0.05,
+            row_titles=[p.split('_')[0] for p in parameters])
+
+        # with many stations the lines are downsampled so that every
+        # chart has about max_points points
+        stations = df.groupby('name', observed=True, sort=False)
+        n_points = self.max_points // max(stations.ngroups, 1) \
+            if self.max_points else None
+        # the traces are plain dicts, validating hundreds of them
+        # by plotly would take longer than the whole rest
+        colors = qualitative.Plotly
+        traces = []
+        for idx, (station, data) in enumerate(stations):
+            data = data.sort_values('date')
+            for row, parameter in enumerate(parameters, start=1):
+                values = data[['date', parameter]].dropna()
+                x, y = values['date'].values, values[parameter].values
+                if n_points:
+                    kept = lttb(x, y, n_points)
+                    x, y = x[kept], y[kept]
+                axis = '' if row == 1 else str(row)
+                traces.append(dict(
+                    type='scatter', mode='lines', xaxis=f'x{axis}',
+                    yaxis=f'y{axis}', x=np.datetime_as_string(x, unit='m'),
+                    y=np.round(y.astype(float), 2), name=station,
+                    legendgroup=station, showlegend=row == 1,
+                    line=dict(color=colors[idx % len(colors)]),
+                    hovertemplate=f'Wetterstation={station}<br>'
+                                  f'Datum=%{{x}}<br>{parameter}=%{{y}}'
+                                  '<extra></extra>'))
+        figure.add_hline(y=0, line_dash="solid",
+                         exclude_empty_subplots=False)
 
         # adjust annotations
         # https://plotly.com/python/reference/layout/annotations/
-        figure.for_each_annotation(
-            lambda a: a.update(text=a.text.split("=")[-1].split("_")[0]))
         figure.update_annotations(x=-0.025, xref='paper',
                                   xanchor='right')  # move to the right
 
         # update axes
         figure.update_yaxes(matches=None, title=None, gridcolor='LightGrey')
         day_min = (date.today() - timedelta(days=0)).strftime('%Y-%m-%d')
-        day_max = (date.today() + timedelta(days=4)).strftime('%Y-%m-%d')
+        day_max = (date.today() + timedelta(
+            days=self.display_days)).strftime('%Y-%m-%d')
         figure.update_xaxes(range=(day_min, day_max), gridcolor='LightGrey')
+        figure.update_xaxes(title='Datum', row=len(parameters))
 
         # update layout
         figure.update_layout(
@@ -153,10 +452,10 @@ class DWD(LocationData):
                 x=0.5
             ))
 
-        if light_mode:
-            figure.update_layout(template='plotly_white')
-        else:
-            figure.update_layout(template="plotly_dark")
+        return dict(figure.to_plotly_json(), data=traces)
 
-        graph = dcc.Graph(id=name, figure=figure, style={'height': '85vh'})
-        return graph
+    @staticmethod
+    def templates() -> dict:
+        # plotly templates of the light and dark theme
+        return {'light': pio.templates['plotly_white'].to_plotly_json(),
+                'dark': pio.templates['plotly_dark'].to_plotly_json()}
@@ -0,0 +1,50 @@
+import threading
+
+import pandas as pd
+import requests
+
+# the latest MOSMIX-S issue, its modification time tells the issue time
+MOSMIX_S_LATEST = 'https://opendata.dwd.de/weather/local_forecasts/mos/' \
+                  'MOSMIX_S/all_stations/kml/MOSMIX_S_LATEST_240.kmz'
+
+
+class Mosmix:
+    """ client of the DWD MOSMIX-S forecasts, wetterdienst (with polars)
+    is slow to import and only loaded on the first request """
+
+    def __init__(self, parameters: list):
+        self.parameters = parameters
+        self._settings = None
+        self._lock = threading.Lock()
+
+    def issue_time(self) -> str:
+        # issue time of the latest forecast as YYYYmmddHHMM
+        response = requests.head(MOSMIX_S_LATEST, timeout=10)
+        response.raise_for_status()
+        issue = pd.Timestamp(response.headers['Last-Modified'])
+        return issue.strftime('%Y%m%d%H%M')
+
+    def stations(self) -> pd.DataFrame:
+        # catalogue of all stations with their coordinates
+        return self._request().all().df.to_pandas()
+
+    def forecast(self, station_ids: list) -> pd.DataFrame:
+        # station_id, dataset, parameter, date, value, quality
+        return self._request().filter_by_station_id(
+            station_ids).values.all().df.to_pandas()
+
+    def _request(self):
+        from wetterdienst.provider.dwd.mosmix import DwdMosmixRequest, \
+            DwdMosmixType
+        from wetterdienst.settings import Settings
+        with self._lock:
+            if self._settings is None:
+                self._settings = Settings(ts_humanize=True, ts_si_units=True,
+                                          ts_skip_empty=True)
+        return DwdMosmixRequest(
+            # parameter='small',
+            parameter=self.parameters,
+            mosmix_type=DwdMosmixType.SMALL,
+            # large is only released very 6 hours (3, 9, 15, 21)
+            settings=self._settings,
+        )
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import time
+import unittest
+
+from src.Cache import SqliteCache
+
+
+class SqliteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'directions.sqlite')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def rows(self, cache: SqliteCache) -> int:
+        return cache._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def test_size_cap(self):
+        cache = SqliteCache(self.path, ttl=60, maxsize=10)
+        for i in range(100):
+            cache.set(('trip', i), str(i))
+        self.assertEqual(len(cache), 10)
+        # the file is pruned every maxsize // 10 + 1 writes
+        self.assertLessEqual(self.rows(cache), 10 + 2)
+        self.assertIsNone(cache.get(('trip', 0)))
+        self.assertEqual(cache.get(('trip', 99)), '99')
+
+    def test_reload(self):
+        cache = SqliteCache(self.path, ttl=60, maxsize=10)
+        for i in range(30):
+            cache.set(('trip', i), str(i))
+        cache.set(('trip', 'expired'), 'x', ttl=0.01)
+        time.sleep(0.02)
+
+        # a new process warm-loads the newest entries
+        reloaded = SqliteCache(self.path, ttl=60, maxsize=10)
+        self.assertEqual(len(reloaded), 10)
+        self.assertLessEqual(self.rows(reloaded), 10)
+        self.assertEqual([reloaded.get(('trip', i)) for i in range(20, 30)],
+                         [str(i) for i in range(20, 30)])
+        self.assertIsNone(reloaded.get(('trip', 'expired')))
+        self.assertIsNone(reloaded.get(('trip', 0)))
+
+    def test_shared_between_processes(self):
+        writer = SqliteCache(self.path, ttl=60, maxsize=10)
+        reader = SqliteCache(self.path, ttl=60, maxsize=10)
+        writer.set(('trip', 1), 'S Spandau')
+        # not in the memory of the reader, read through from the file
+        self.assertEqual(reader.get(('trip', 1)), 'S Spandau')
+        self.assertEqual(reader.stats()['hits'], 1)
+        writer.pop(('trip', 1))
+        self.assertIsNone(SqliteCache(self.path).get(('trip', 1)))
@@ -0,0 +1,60 @@
+import time
+import unittest
+
+from src.LocationData import LocationData
+
+
+class Locations(LocationData):
+    # every name but 'nowhere' is found
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.searches = []
+
+    def find_locations(self, name, number):
+        self.searches.append(name)
+        if name == 'nowhere':
+            return []
+        self._add_locations({name: f'stop {name}'})
+        return [name]
+
+    def get_data(self, name):
+        return None
+
+
+class LocationDataTest(unittest.TestCase):
+
+    def test_shared_locations_are_kept(self):
+        locations = Locations()
+        locations.update_locations(['Zoo', 'Hbf'], subscriber='tab 1')
+        locations.update_locations(['Zoo'], subscriber='tab 2')
+        # renewing a selection does not count twice
+        locations.update_locations(['Zoo', 'Hbf'], subscriber='tab 1')
+        self.assertEqual(locations._refcounts, {'Zoo': 2, 'Hbf': 1})
+
+        locations.update_locations(['Ostkreuz'], subscriber='tab 1')
+        self.assertEqual(set(locations._locations), {'Zoo', 'Ostkreuz'})
+        locations.update_locations([], subscriber='tab 2')
+        self.assertEqual(set(locations._locations), {'Ostkreuz'})
+        self.assertEqual(locations._refcounts, {'Ostkreuz': 1})
+        # every location was only looked up once
+        self.assertEqual(sorted(locations.searches),
+                         ['Hbf', 'Ostkreuz', 'Zoo'])
+
+    def test_expired_subscribers_are_dropped(self):
+        locations = Locations(subscriber_expiry=0.05)
+        locations.update_locations(['Zoo', 'Hbf'], subscriber='closed tab')
+        locations.update_locations(['Zoo'], subscriber='open tab')
+        time.sleep(0.06)
+        locations.update_locations(['Zoo'], subscriber='open tab')
+        self.assertEqual(set(locations._locations), {'Zoo'})
+        self.assertEqual(locations._refcounts, {'Zoo': 1})
+
+    def test_get_location(self):
+        locations = Locations()
+        locations.update_locations(['Zoo'], subscriber='tab 1')
+        locations.update_locations([], subscriber='tab 1')
+        # a location of another worker or an expired subscriber is
+        # looked up again
+        self.assertEqual(locations.get_location('Zoo'), 'stop Zoo')
+        with self.assertRaises(KeyError):
+            locations.get_location('nowhere')
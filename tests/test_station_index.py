@@ -0,0 +1,82 @@
+import unittest
+from unittest import mock
+
+from pyhafas.types.fptf import Station
+
+from src.transport.Hafas import Hafas
+from src.transport.StationIndex import StationIndex, Stop
+
+# stations HAFAS finds per search, in its order
+SEARCHES = {
+    'Zoo': ['Zoo', 'Berlin Zoo'],
+    'Berlin Zoo': ['Berlin Zoo', 'Zoo'],
+    'Berlin': ['Berlin Hbf', 'Berlin Zoo', 'Berlin Adlershof',
+               'Berlin Alexanderplatz', 'Berlin Bellevue', 'Berlin Buch'],
+}
+
+
+def stops(names: list) -> list:
+    return [Stop(id=str(i), name=name) for i, name in enumerate(names)]
+
+
+class HafasClient:
+    def __init__(self):
+        self.searches = []
+
+    def locations(self, name: str) -> list:
+        self.searches.append(name)
+        return [Station(id=str(i), name=station)
+                for i, station in enumerate(SEARCHES.get(name, []))]
+
+
+class StationIndexTest(unittest.TestCase):
+
+    def test_exact_name_first(self):
+        index = StationIndex()
+        index.add(stops(SEARCHES['Berlin Zoo']), search='Berlin Zoo')
+        self.assertTrue(index.knows('Zoo', 1))
+        self.assertEqual([s.name for s in index.find('Zoo', 1)], ['Zoo'])
+        # 'Berlin Zoo' comes first in the index
+        self.assertEqual([s.name for s in index.find('Zoo', 5)],
+                         ['Zoo', 'Berlin Zoo'])
+
+    def test_only_searched_prefixes_are_known(self):
+        index = StationIndex()
+        index.add(stops(SEARCHES['Berlin']), search='Berlin')
+        self.assertTrue(index.knows('berlin', 5))
+        self.assertTrue(index.knows('Berlin B', 5))
+        self.assertFalse(index.knows('Berl', 5))
+        self.assertFalse(index.knows('Zoo', 5))
+
+    def test_upstream_order(self):
+        index = StationIndex()
+        index.add(stops(SEARCHES['Berlin']), search='Berlin')
+        index.add(stops(['Berlin Alt-Mariendorf']))
+        self.assertEqual([s.name for s in index.find('Berlin', 3)],
+                         ['Berlin Hbf', 'Berlin Zoo', 'Berlin Adlershof'])
+        # names HAFAS did not give for the search follow
+        self.assertEqual([s.name for s in index.find('Berlin A', 5)],
+                         ['Berlin Adlershof', 'Berlin Alexanderplatz',
+                          'Berlin Alt-Mariendorf'])
+
+
+@mock.patch('src.Cache.CACHE_BACKEND', 'memory')
+class FindLocationsTest(unittest.TestCase):
+
+    def test_selected_location_is_found(self):
+        client = HafasClient()
+        hafas = Hafas(client=client)
+        self.assertEqual(hafas.find_locations('Berlin Zoo', 5),
+                         ['Berlin Zoo', 'Zoo'])
+        hafas.update_locations(['Zoo'], subscriber='tab')
+        self.assertEqual(hafas.get_location('Zoo').name, 'Zoo')
+        self.assertEqual(client.searches, ['Berlin Zoo'])
+
+    def test_repeated_search_keeps_the_order(self):
+        client = HafasClient()
+        hafas = Hafas(client=client)
+        first = hafas.find_locations('Berlin', 5)
+        self.assertEqual(first[0], 'Berlin Hbf')
+        self.assertTrue(hafas.knows_locations('Berlin', 5))
+        self.assertEqual(hafas.find_locations('Berlin', 5), first)
+        self.assertEqual(client.searches, ['Berlin'])
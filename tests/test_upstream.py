@@ -0,0 +1,126 @@
+import threading
+import time
+import unittest
+
+from src.Upstream import CircuitOpenError, Upstream
+
+
+class Fetch:
+    # counts its calls and raises error if given
+    def __init__(self, result=None, error: Exception = None):
+        self.result = result
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class UpstreamTest(unittest.TestCase):
+
+    def upstream(self, **kwargs) -> Upstream:
+        kwargs = {'retries': 0, 'backoff': 0, 'failure_threshold': 3,
+                  'reset_timeout': 0.05, **kwargs}
+        return Upstream('test', **kwargs)
+
+    def test_coalesces_concurrent_calls(self):
+        upstream = self.upstream()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'departures'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(
+            upstream.call('departures', 'station', fetch)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(
+            upstream.call('departures', 'station', fetch)))
+            for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['departures'] * 4)
+        # the next call is a new one
+        upstream.call('departures', 'station', fetch)
+        self.assertEqual(len(calls), 2)
+
+    def test_retries_outages(self):
+        upstream = self.upstream(retries=2)
+        fetch = Fetch(error=ConnectionError('down'))
+        with self.assertRaises(ConnectionError):
+            upstream.call('departures', 'station', fetch)
+        self.assertEqual(fetch.calls, 3)
+
+    def test_circuit_opens_after_outages(self):
+        upstream = self.upstream()
+        fetch = Fetch(error=TimeoutError('slow'))
+        for _ in range(3):
+            with self.assertRaises(TimeoutError):
+                upstream.call('departures', 'station', fetch)
+        self.assertEqual(upstream.state(), 'open')
+        with self.assertRaises(CircuitOpenError):
+            upstream.call('departures', 'station', fetch)
+        self.assertEqual(fetch.calls, 3)
+
+    def test_half_open_probe(self):
+        upstream = self.upstream()
+        fetch = Fetch(error=ConnectionError('down'))
+        for _ in range(3):
+            with self.assertRaises(ConnectionError):
+                upstream.call('departures', 'station', fetch)
+        time.sleep(0.06)
+        self.assertEqual(upstream.state(), 'half_open')
+        # a failed trial call opens the circuit again
+        with self.assertRaises(ConnectionError):
+            upstream.call('departures', 'station', fetch)
+        self.assertEqual(upstream.state(), 'open')
+        time.sleep(0.06)
+        # a successful one closes it
+        fetch.error = None
+        fetch.result = 'departures'
+        self.assertEqual(upstream.call('departures', 'station', fetch),
+                         'departures')
+        self.assertEqual(upstream.state(), 'closed')
+
+    def test_request_errors_do_not_count(self):
+        upstream = self.upstream(retries=2)
+        fetch = Fetch(error=KeyError('unknown trip'))
+        for trip in range(10):
+            with self.assertRaises(KeyError):
+                upstream.call('trip', trip, fetch)
+        # neither retried nor counted toward the circuit
+        self.assertEqual(fetch.calls, 10)
+        self.assertEqual(upstream.state(), 'closed')
+
+    def test_stale_result_only_on_outages(self):
+        upstream = self.upstream()
+        upstream.call('departures', 'station', Fetch('departures'))
+        self.assertEqual(upstream.call(
+            'departures', 'station', Fetch(error=ConnectionError('down'))),
+            'departures')
+        with self.assertRaises(KeyError):
+            upstream.call('departures', 'station',
+                          Fetch(error=KeyError('unknown station')))
+        # also while the circuit is open
+        for _ in range(2):
+            upstream.call('departures', 'station',
+                          Fetch(error=ConnectionError('down')))
+        self.assertEqual(upstream.state(), 'open')
+        self.assertEqual(upstream.call('departures', 'station', Fetch()),
+                         'departures')
+        # nothing to serve for other calls
+        with self.assertRaises(CircuitOpenError):
+            upstream.call('departures', 'other station', Fetch())